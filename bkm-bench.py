@@ -0,0 +1,346 @@
+import gc
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import subprocess
+import statistics
+import tempfile
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bookmark import Bookmark, BookmarkCollection
+
+
+def main(args):
+  if args['memory']:
+    benchmark_memory(args['memory'])
+  if args['validation']:
+    benchmark_validation(args['validation'], args['latency'], args['workers'])
+  if args['imports'] and not benchmark_imports(args['imports'], args['budget'], args['runs']):
+    sys.exit(1)
+
+
+def generate_bookmarks_json(n, seed=0):
+  rnd = random.Random(seed)
+  tags = [f'tag-{i}' for i in range(200)]
+  categories = [f'Category {i} > Sub {j}' for i in range(20) for j in range(10)]
+  start = datetime(2015, 1, 1)
+  bookmarks = []
+  for i in range(n):
+    b = Bookmark(f'https://host-{rnd.randrange(n // 10 + 1)}.com/path/{i}', f'Page title {i}')
+    b.created = start + timedelta(seconds=rnd.randrange(10 ** 8))
+    b.tags = rnd.sample(tags, rnd.randint(1, 3))
+    b.categories = rnd.choice(categories)
+    b.mtype = 'text/html'
+    bookmarks.append(b.json)
+  return bookmarks
+
+
+def parse_bookmarks(lines):
+  bookmarks = []
+  for line in lines:
+    bookmark = Bookmark()
+    bookmark.parse_json(json.loads(line))
+    bookmarks.append(bookmark)
+  return bookmarks
+
+
+def benchmark_memory(n):
+  lines = [json.dumps(bjson) for bjson in generate_bookmarks_json(n)]
+
+  start = time.perf_counter()
+  bookmarks = parse_bookmarks(lines)
+  elapsed = time.perf_counter() - start
+  roundtrip = all(b.json == json.loads(line) for b, line in zip(bookmarks, lines))
+  del bookmarks
+
+  # traced separately, tracemalloc slows allocations down too much to time them
+  gc.collect()
+  tracemalloc.start()
+  bookmarks = parse_bookmarks(lines)
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  print(f'bookmarks: {n}')
+  print(f'parse time: {elapsed:.2f}s ({n / elapsed:.0f} bookmarks/s)')
+  print(f'memory: {current / 2 ** 20:.1f} MiB ({current / n:.0f} bytes/bookmark)')
+  print(f'peak memory: {peak / 2 ** 20:.1f} MiB')
+  print(f'json round-trip: {"ok" if roundtrip else "FAILED"}')
+
+
+# kinds of pages served to validation benchmarks, requested in turns
+page_kinds = ['page', 'page', 'page', 'redirect', 'big', 'notitle', 'binary', 'nohead', 'notfound', 'error', 'drop']
+# kinds the collection knows to be html pages from earlier validations
+html_kinds = ['page', 'redirect', 'big', 'notitle']
+
+
+class BenchmarkHandler(BaseHTTPRequestHandler):
+  # local stand-in for the sites of a bookmark collection, pages are picked by the first path segment
+
+  protocol_version = 'HTTP/1.1'
+  latency = 0
+  sent = None
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.serve(True)
+
+  def do_HEAD(self):
+    self.serve(False)
+
+  def serve(self, send_body):
+    time.sleep(self.latency)
+    kind = self.path.split('/')[1]
+    if kind == 'drop':
+      self.close_connection = True
+      return
+    if kind == 'redirect':
+      return self.respond(301, b'', headers={'Location': self.path.replace('/redirect/', '/page/', 1)}, send_body=send_body)
+    if kind == 'notfound':
+      return self.respond(404, b'not found', send_body=send_body)
+    if kind == 'error':
+      return self.respond(500, b'server error', send_body=send_body)
+    # servers rejecting HEAD requests, serving a download
+    if kind == 'nohead' and not send_body:
+      return self.respond(405, b'method not allowed', send_body=send_body)
+    if kind in ['binary', 'nohead']:
+      return self.respond(200, bytes(1024 * 1024), 'application/octet-stream', send_body=send_body)
+    title = '' if kind == 'notitle' else f'<title>Page {self.path}</title>'
+    body = 'x' * (2 * 1024 * 1024 if kind == 'big' else 10 * 1024)
+    self.respond(200, f'<html><head>{title}</head><body>{body}</body></html>'.encode(), send_body=send_body)
+
+  def respond(self, status, body, ctype='text/html; charset=utf-8', headers={}, send_body=True):
+    self.send_response(status)
+    self.send_header('Content-Type', ctype)
+    self.send_header('Content-Length', str(len(body)))
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.end_headers()
+    if not send_body: return
+    # sent in chunks to count what is transferred before the client stops reading
+    for i in range(0, len(body), 64 * 1024):
+      try:
+        self.wfile.write(body[i:i + 64 * 1024])
+      except ConnectionError:
+        self.close_connection = True
+        return
+      with self.sent.get_lock():
+        self.sent.value += len(body[i:i + 64 * 1024])
+
+
+class BenchmarkServer(ThreadingHTTPServer):
+
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    # connections reset by clients that stop reading early
+    pass
+
+
+def run_benchmark_server(latency, port, sent):
+  BenchmarkHandler.latency = latency
+  BenchmarkHandler.sent = sent
+  server = BenchmarkServer(('127.0.0.1', 0), BenchmarkHandler)
+  port.value = server.server_address[1]
+  server.serve_forever()
+
+
+def benchmark_validation(n, latency, workers):
+  # the server runs in its own process, so it neither competes for the GIL nor counts in the peak RSS
+  port = multiprocessing.Value('i', 0)
+  sent = multiprocessing.Value('q', 0)
+  server = multiprocessing.Process(target=run_benchmark_server, args=(latency / 1000, port, sent), daemon=True)
+  server.start()
+  while not port.value:
+    time.sleep(0.01)
+  # failed requests are expected, keep their errors out of the report
+  logging.getLogger('bkm-org').addHandler(logging.NullHandler())
+
+  bc = BookmarkCollection()
+  for i in range(n):
+    kind = page_kinds[i % len(page_kinds)]
+    b = Bookmark(f'http://127.0.0.1:{port.value}/{kind}/{i}', f'Page {i}')
+    # known html pages get their title fetched, other urls only need their headers
+    if kind in html_kinds:
+      b.mtype = 'text/html'
+    bc.add(b)
+
+  latencies = []
+  verify = Bookmark.verify
+
+  def timed_verify(b, session=None, snapshots=None):
+    start = time.perf_counter()
+    try:
+      return verify(b, session, snapshots)
+    finally:
+      latencies.append(time.perf_counter() - start)
+
+  Bookmark.verify = timed_verify
+  try:
+    start = time.perf_counter()
+    bc.validate(workers=workers, host_workers=workers, host_failures=0)
+    elapsed = time.perf_counter() - start
+  finally:
+    Bookmark.verify = verify
+    server.terminate()
+
+  statuses = {}
+  for b in bc.bookmarks:
+    statuses[b.status['code']] = statuses.get(b.status['code'], 0) + 1
+  p50, p95, p99 = [statistics.quantiles(latencies, n=100)[i] * 1000 for i in (49, 94, 98)]
+
+  print(f'urls: {n} ({workers} workers, {latency}ms server latency)')
+  print(f'validation time: {elapsed:.2f}s ({n / elapsed:.1f} urls/s)')
+  print(f'latency: p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms')
+  print(f'bytes transferred: {sent.value / 2 ** 20:.1f} MiB ({sent.value / n:.0f} bytes/url)')
+  read = sum(b.lrequest.transferred or 0 for b in bc.bookmarks)
+  print(f'bytes read: {read / 2 ** 20:.1f} MiB ({read / n:.0f} bytes/url)')
+  print(f'peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+  print(f'status codes: {dict(sorted(statuses.items()))}')
+
+
+# commands that neither reach the network nor parse html, so they shouldn't import the modules doing it
+startup_commands = {
+    'list': ['-l', 'tag', 'tag-1'],
+    'delete': ['-l', 'tag', 'tag-1', '-d'],
+}
+network_modules = ['requests', 'urllib3', 'bs4', 'tld', 'cgi']
+
+
+def get_imports(command, cwd):
+  # top-level imports with their cumulative time in milliseconds, from python -X importtime
+  env = dict(os.environ)
+  # cached bytecode is part of a normal startup
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  start = time.perf_counter()
+  process = subprocess.run([sys.executable, '-X', 'importtime', *command], cwd=cwd, env=env, capture_output=True, text=True)
+  elapsed = (time.perf_counter() - start) * 1000
+  if process.returncode:
+    raise RuntimeError(f'{" ".join(command)} failed: {process.stderr[-1000:]}')
+  imports = {}
+  for line in process.stderr.splitlines():
+    if not line.startswith('import time:') or line.endswith('imported package'): continue
+    _, cumulative, name = line[12:].split('|')
+    if not name.startswith('  '):
+      imports[name.strip()] = int(cumulative) / 1000
+  return imports, elapsed
+
+
+def benchmark_imports(n, budget, runs):
+  script = Path(__file__).resolve().with_name('bkm-org.py')
+  with tempfile.TemporaryDirectory() as tmp:
+    tmp = Path(tmp)
+    (tmp / 'config').mkdir()
+    (tmp / 'logs').mkdir()
+    (tmp / 'config' / 'config.ini').write_text('[global]\nlog_path = logs\n[bkm-org]\ncollection_fpath = col.json\n')
+    bc = BookmarkCollection()
+    for bjson in generate_bookmarks_json(n):
+      b = Bookmark()
+      b.parse_json(bjson)
+      bc.add(b)
+    bc.write_json(tmp / 'col.json')
+    collection = (tmp / 'col.json').read_text()
+
+    # imports done by the interpreter itself are left out
+    interpreter, _ = get_imports(['-c', 'pass'], tmp)
+    ok = True
+    print(f'bookmarks: {n} (median of {runs} runs)')
+    for name, command in startup_commands.items():
+      results = []
+      # the first run writes the bytecode caches
+      for _ in range(runs + 1):
+        for f in tmp.glob('col.*'):
+          f.unlink()
+        (tmp / 'col.json').write_text(collection)
+        results.append(get_imports([str(script), *command, '--local'], tmp))
+      results = results[1:]
+      totals = [sum(t for m, t in imports.items() if m not in interpreter) for imports, _ in results]
+      imports, _ = results[totals.index(statistics.median_low(totals))]
+      elapsed = statistics.median(e for _, e in results)
+      loaded = [m for m in network_modules if m in imports]
+      within = statistics.median(totals) <= budget and not loaded
+      ok = ok and within
+      slowest = sorted(((t, m) for m, t in imports.items() if m not in interpreter), reverse=True)[:5]
+      print(f'{name}: imports {statistics.median(totals):.1f}ms (budget {budget:.0f}ms), process {elapsed:.1f}ms, {"ok" if within else "OVER BUDGET"}')
+      print(f'  slowest imports: {", ".join(f"{m} {t:.1f}ms" for t, m in slowest)}')
+      print(f'  network and html modules: {", ".join(loaded) if loaded else "none"}')
+  return ok
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+      description='Bookmark organizer benchmarks',
+      formatter_class=argparse.RawTextHelpFormatter
+  )
+  parser.add_argument(
+      '-m',
+      '--memory',
+      action='store',
+      type=int,
+      metavar='N',
+      help='Measure memory used by N bookmarks parsed from json'
+  )
+  parser.add_argument(
+      '-V',
+      '--validation',
+      action='store',
+      type=int,
+      metavar='N',
+      help='Measure validation throughput of N urls served by a local http server'
+  )
+  parser.add_argument(
+      '--latency',
+      action='store',
+      type=float,
+      default=20,
+      metavar='MS',
+      help='Latency added by the local http server to each response'
+  )
+  parser.add_argument(
+      '-w',
+      '--workers',
+      action='store',
+      type=int,
+      default=8,
+      help='Number of concurrent connections used in validation benchmarks'
+  )
+  parser.add_argument(
+      '-I',
+      '--imports',
+      action='store',
+      type=int,
+      metavar='N',
+      help='Measure import time of the list and delete commands on a collection of N bookmarks,\nfailing when over budget or when they import the network and html modules'
+  )
+  parser.add_argument(
+      '--budget',
+      action='store',
+      type=float,
+      default=75,
+      metavar='MS',
+      help='Import time budget of the list and delete commands'
+  )
+  parser.add_argument(
+      '--runs',
+      action='store',
+      type=int,
+      default=5,
+      help='Number of runs of each command in import benchmarks'
+  )
+  return parser
+
+
+if __name__ == "__main__":
+  parser = get_parser()
+  args = vars(parser.parse_args())
+  main(args)
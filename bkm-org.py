@@ -1,15 +1,42 @@
+import io
+import os
+import sys
+import shlex
 import argparse
+import tempfile
 from pathlib import Path
+from datetime import timedelta
+from contextlib import redirect_stdout
 
 from modules import log
 from modules import config
-from bookmark import Bookmark, BookmarkCollection
+from modules import daemon
+from modules.metrics import metrics
+from bookmark import Bookmark, BookmarkCollection, fetch_titles
 
 
 config = config.get_config('config')
 log_path = Path(config['global']['log_path'])
 logger = log.get_logger('bkm-org', log_path=log_path)
 
+Bookmark.title_max_bytes = config['bkm-org'].getint('title_max_bytes', Bookmark.title_max_bytes)
+Bookmark.page_max_bytes = config['bkm-org'].getint('page_max_bytes', Bookmark.page_max_bytes)
+BookmarkCollection.snapshots_max_bytes = config['bkm-org'].getint('snapshots_max_bytes', BookmarkCollection.snapshots_max_bytes)
+BookmarkCollection.journal_max_bytes = config['bkm-org'].getint('journal_max_bytes', BookmarkCollection.journal_max_bytes)
+BookmarkCollection.checkpoint_every = config['bkm-org'].getint('checkpoint_every', BookmarkCollection.checkpoint_every)
+BookmarkCollection.checkpoint_seconds = config['bkm-org'].getfloat('checkpoint_seconds', BookmarkCollection.checkpoint_seconds)
+BookmarkCollection.canonical_urls = config['bkm-org'].getboolean('canonical_urls', BookmarkCollection.canonical_urls)
+if 'canonical_ignore_params' in config['bkm-org']:
+  BookmarkCollection.canonical_ignore_params = [p.strip() for p in config['bkm-org']['canonical_ignore_params'].split(',') if p.strip()]
+
+daemon_fpath = Path(config['bkm-org'].get('daemon_socket', Path(tempfile.gettempdir()) / f'bkm-org-{os.getuid()}.sock'))
+daemon_flush_seconds = config['bkm-org'].getfloat('daemon_flush_seconds', 30)
+
+# collections kept in memory by the daemon, with the state of their files and the ones not saved yet
+resident = None
+resident_stamps = {}
+unsaved = set()
+
 
 def main(args):
 
@@ -20,24 +47,67 @@ def main(args):
   else:
     collection_fpath = Path(config['bkm-org']['collection_fpath'])
 
+  if args['export']:
+    bc = open_collection(collection_fpath)
+    bc.write(Path(args['export']))
+    print(f'exported to {args["export"]}')
+    return
+
+  if args['compact']:
+    bc = open_collection(collection_fpath)
+    save_bookmarks(bc, compact=True)
+    return
+
   if args['sync']:
     utype = args['sync']
-    bc = BookmarkCollection(collection_fpath)
+    bc = open_collection(collection_fpath)
     sync_bookmarks(bc, utype)
     return
 
   if args['import']:
+    if len(args['import']) < 2:
+      raise ValueError('import needs a type and at least one file')
     itype = args['import'][0]
-    fpath = args['import'][1]
-    bc = BookmarkCollection()
-    if collection_fpath.stat().st_size > 0:
-      bc.load(collection_fpath)
-    import_bookmarks(bc, itype, fpath, collection_fpath)
+    fpaths = args['import'][1:]
+    bc = open_collection(collection_fpath) if collection_fpath.stat().st_size > 0 else BookmarkCollection()
+    import_bookmarks(bc, itype, fpaths, collection_fpath)
+    return
+
+  if args['batch']:
+    bc = open_collection(collection_fpath)
+    if args['rollback'] and bc.fpath in unsaved:
+      # changes kept by the daemon are saved first, rolling back only discards the batch
+      bc.save()
+      unsaved.discard(bc.fpath)
+    if args['batch'] == '-':
+      run_batch(bc, sys.stdin.read().splitlines(), args['rollback'], args['workers'] or 8)
+    else:
+      with open(args['batch'], encoding='utf-8') as file:
+        run_batch(bc, file.read().splitlines(), args['rollback'], args['workers'] or 8)
+    return
+
+  if args['duplicates']:
+    bc = open_collection(collection_fpath)
+    clusters, similar_clusters = bc.find_near_duplicates(args['similarity'])
+    print_clusters(clusters)
+    if similar_clusters:
+      print('similar but different pages (never merged):')
+      print_clusters(similar_clusters)
+    if args['duplicates'] == 'merge' and clusters:
+      bc.merge_duplicates(clusters)
+      save_bookmarks(bc)
     return
 
   urls = None
+  if args['search']:
+    bc = open_collection(collection_fpath, lazy=True)
+    urls = bc.search(args['search'], args['limit'])
+    if should_print(args):
+      print_list(urls)
+      return
+
   if args['list']:
-    bc = BookmarkCollection(collection_fpath)
+    bc = open_collection(collection_fpath, lazy=True)
     ltype = args['list'][0]
     value = args['list'][1] if len(args['list']) > 1 else None
     if value:
@@ -52,7 +122,7 @@ def main(args):
         return
 
   if args['validate']:
-    bc = BookmarkCollection(collection_fpath)
+    bc = open_collection(collection_fpath)
     if urls:
       for u in urls:
         validate_url(bc, u)
@@ -60,14 +130,19 @@ def main(args):
     else:
       url = args['validate']
       if url == 'collection':
-        bc.validate()
+        ttl = timedelta(days=args['ttl']) if args['ttl'] else None
+        tripped = bc.validate(
+            workers=args['workers'] or 1, ttl=ttl, host_failures=args['host_failures'], checkpoint=True, resume=args['resume']
+        )
+        for host, skipped in tripped.items():
+          print(f'{host}: stopped after {args["host_failures"]} connection failures, {skipped} urls not requested')
         save_bookmarks(bc)
       else:
         validate_url(bc, url)
     return
 
   if args['add']:
-    bc = BookmarkCollection(collection_fpath)
+    bc = open_collection(collection_fpath)
     if urls:
       tags = args['add'][0].split(',')
       for u in urls:
@@ -84,7 +159,7 @@ def main(args):
     return
 
   if args['delete']:
-    bc = BookmarkCollection(collection_fpath)
+    bc = open_collection(collection_fpath)
     if urls:
       for u in urls:
         delete_url(bc, u)
@@ -121,6 +196,14 @@ title: {b.last_request.title}
 redirect: {b.last_request.redirect}""")
 
 
+def print_clusters(clusters):
+  for i, cluster in enumerate(clusters, start=1):
+    print(f'cluster {i}:')
+    for b in cluster:
+      print(f'  {b.url} ({b.title})')
+  print(f'{len(clusters)} clusters, {sum(len(c) for c in clusters)} bookmarks')
+
+
 def print_list(li):
   print('\n'.join(li))
 
@@ -142,15 +225,18 @@ def sync_bookmarks(bc, utype):
   elif utype == 'md':
     bc.write_md()
   elif utype == 'json':
-    bc.import_md()
-    bc.write_json()
+    report = bc.import_md()
+    bc.write()
+    for change, urls in report.items():
+      print(f'{change}: {len(urls)}')
+      for url in urls:
+        logger.debug(f'{change}: {url}')
 
 
-def import_bookmarks(bc, itype, input, output):
-  if itype == 'nbff':
-    bc.import_nbff(input)
-  elif itype == 'insta':
-    bc.import_instapaper(input)
+def import_bookmarks(bc, itype, inputs, output):
+  summary = bc.import_files(itype, inputs)
+  for result, count in summary.items():
+    print(f'{result}: {count}')
   bc.write(output)
 
 
@@ -177,11 +263,156 @@ def delete_url(bc, url):
     print(f'{url}: not able to delete url from collection')
 
 
-def save_bookmarks(bc):
-  bc.write()
+def run_batch(bc, lines, rollback=False, workers=8):
+  # commands are applied in order and saved together, reporting the result of each line
+  commands = []
+  for n, line in enumerate(lines, start=1):
+    line = line.strip()
+    if not line or line.startswith('#'): continue
+    try:
+      words = shlex.split(line)
+    except ValueError:
+      # unbalanced quotes, reported as an invalid command
+      words = [line]
+    commands.append((n, words))
+
+  # titles of the urls to add are fetched first, concurrently
+  added = [w[1] for _, w in commands if w[0] == 'add' and len(w) > 1 and not bc.find_by_canonical_url(w[1])]
+  urls = list(dict.fromkeys(added))
+  titles = dict(zip(urls, fetch_titles(urls, workers))) if urls else {}
+
+  failed = 0
+  for n, words in commands:
+    try:
+      result = apply_command(bc, words, titles)
+    except ValueError as e:
+      failed += 1
+      print(f'{n}: failed: {e}')
+    else:
+      print(f'{n}: {result}')
+
+  if failed and rollback:
+    discard_changes(bc)
+    print(f'{failed} of {len(commands)} commands failed, no changes saved')
+    return
+  if failed:
+    print(f'{failed} of {len(commands)} commands failed')
+  if len(commands) > failed:
+    save_bookmarks(bc)
+
+
+def apply_command(bc, words, titles):
+  # a batch command, like the add and delete options, raising ValueError when it cannot be applied
+  command, args = words[0], words[1:]
+  if command == 'add' and len(args) in [1, 2]:
+    url = args[0]
+    tags = args[1].split(',') if len(args) > 1 else None
+    if bc.add(Bookmark(url, titles.get(url, ''), tags=tags)):
+      return f'{url}: successfully added to collection'
+    if tags and bc.add_tags(url, tags):
+      return f"{url}: successfully added tags '{tags}' to url"
+    raise ValueError(f'{url}: not able to add url to collection')
+  if command == 'delete' and len(args) == 1:
+    if bc.delete_url(args[0]):
+      return f'{args[0]}: successfully deleted from collection'
+    raise ValueError(f'{args[0]}: not able to delete url from collection')
+  if command == 'delete' and len(args) == 2:
+    if bc.delete_tag(*args):
+      return f"{args[0]}: successfully deleted tag '{args[1]}'"
+    raise ValueError(f"{args[0]}: not able to delete tag '{args[1]}'")
+  if command == 'title' and len(args) > 1:
+    bookmark = bc.find_by_canonical_url(args[0])
+    if not bookmark:
+      raise ValueError(f'{args[0]}: not able to find url in collection')
+    title = ' '.join(args[1:])
+    if bookmark.title != title:
+      bc.update_title(bookmark, title)
+    return f"{args[0]}: successfully set title '{title}'"
+  raise ValueError(f"not a valid command '{' '.join(words)}'")
+
+
+def discard_changes(bc):
+  # changes are only written when saved, the daemon reloads the collection instead of keeping them
+  if resident is not None:
+    resident.pop(bc.fpath, None)
+    unsaved.discard(bc.fpath)
+
+
+def report_metrics(args):
+  if args['stats']:
+    print(metrics.format())
+  if args['metrics']:
+    metrics.write(args['metrics'])
+
+
+def open_collection(fpath, lazy=False):
+  if resident is None:
+    return BookmarkCollection(fpath, lazy=lazy)
+  # the daemon reloads collections changed on disk by someone else, unless it has unsaved changes
+  fpath = fpath.resolve()
+  bc = resident.get(fpath)
+  if bc is None or fpath not in unsaved and bc.files_stamp() != resident_stamps[fpath]:
+    bc = resident[fpath] = BookmarkCollection(fpath)
+    resident_stamps[fpath] = bc.files_stamp()
+  return bc
+
+
+def save_bookmarks(bc, compact=False):
+  if resident is not None and not compact:
+    unsaved.add(bc.fpath)
+    print(f'changes kept by the daemon, saved at {bc.fpath} within {daemon_flush_seconds:.0f}s')
+    return
+  bc.save(compact)
+  unsaved.discard(bc.fpath)
   print(f'saved at {bc.fpath}')
 
 
+def flush_resident():
+  for fpath in unsaved:
+    resident[fpath].save()
+    logger.info(f'saved at {fpath}')
+  unsaved.clear()
+  for fpath, bc in resident.items():
+    resident_stamps[fpath] = bc.files_stamp()
+
+
+def handle_request(data):
+  # runs a command sent by a client, from its working directory, returning what it printed
+  os.chdir(data['cwd'])
+  args = vars(get_parser().parse_args(data['argv']))
+  output = io.StringIO()
+  error = None
+  stdin = sys.stdin
+  sys.stdin = io.StringIO(data.get('stdin', ''))
+  with redirect_stdout(output):
+    metrics.reset()
+    try:
+      run(args)
+    except Exception as e:
+      logger.exception(e)
+      error = f'{type(e).__name__}: {e}'
+    finally:
+      sys.stdin = stdin
+  # collections written in full by the command are up to date on disk
+  for fpath, bc in resident.items():
+    if fpath not in unsaved:
+      resident_stamps[fpath] = bc.files_stamp()
+  return {"output": output.getvalue(), "error": error}
+
+
+def serve():
+  global resident
+  resident = {}
+  print(f'listening at {daemon_fpath}')
+  daemon.Daemon(daemon_fpath, handle_request, flush_resident, daemon_flush_seconds).serve_forever()
+
+
+def run(args):
+  metrics.enabled = args['stats'] or args['metrics'] is not None
+  main(args)
+  report_metrics(args)
+
+
 def get_parser():
   parser = argparse.ArgumentParser(
       description='Bookmark file manager',
@@ -194,6 +425,38 @@ def get_parser():
       action='store',
       help='Specify bookmark file'
   ),
+  parser.add_argument(
+      '-S',
+      '--search',
+      action='store',
+      metavar='QUERY',
+      help='Search bookmark titles, urls, tags and categories, best matches first. Words ending with * match as prefixes'
+  ),
+  parser.add_argument(
+      '--duplicates',
+      action='store',
+      nargs='?',
+      const='report',
+      choices=['report', 'merge'],
+      help="""Find bookmarks with similar urls for the same page, and bookmarks only sharing similar titles
+or similar urls of different pages (same last path segment and query required):
+    report: list clusters of near-duplicate bookmarks (default)
+    merge: also merge each cluster of similar urls for the same page into its earliest bookmark"""
+  ),
+  parser.add_argument(
+      '--similarity',
+      action='store',
+      type=float,
+      default=0.8,
+      help='Minimum similarity (jaccard index of title words or url tokens) of near-duplicate bookmarks'
+  ),
+  parser.add_argument(
+      '--limit',
+      action='store',
+      type=int,
+      default=20,
+      help='Maximum number of bookmarks found by a search'
+  ),
   parser.add_argument(
       '-v',
       '--validate',
@@ -202,6 +465,31 @@ def get_parser():
       const='collection',
       help='Validate urls. If not url is given, validate bookmark collection'
   ),
+  parser.add_argument(
+      '-w',
+      '--workers',
+      action='store',
+      type=int,
+      help='Number of concurrent connections used when validating the bookmark collection (1 by default)\nor fetching the titles of the urls added by a batch (8 by default)'
+  ),
+  parser.add_argument(
+      '--ttl',
+      action='store',
+      type=float,
+      help='Skip bookmarks validated within the last TTL days when validating the bookmark collection'
+  ),
+  parser.add_argument(
+      '--resume',
+      action='store_true',
+      help='Resume an interrupted validation of the bookmark collection, skipping the bookmarks it already validated'
+  ),
+  parser.add_argument(
+      '--host-failures',
+      action='store',
+      type=int,
+      default=5,
+      help='Stop requesting a host after N consecutive connection failures when validating the bookmark collection (0 never stops)'
+  ),
   parser.add_argument(
       '-l',
       '--list',
@@ -228,15 +516,65 @@ def get_parser():
       choices=['url', 'title', 'md', 'json'],
       help='Sync json file'
   ),
+  parser.add_argument(
+      '-c',
+      '--compact',
+      action='store_true',
+      help='Write pending journal changes into the bookmark file'
+  ),
+  parser.add_argument(
+      '-e',
+      '--export',
+      action='store',
+      help='Export bookmark collection to a json, md or db (sqlite) file'
+  ),
+  parser.add_argument(
+      '--daemon',
+      action='store_true',
+      help='Keep bookmark collections in memory and run the commands of other bkm-org calls, saving them periodically'
+  ),
+  parser.add_argument(
+      '--local',
+      action='store_true',
+      help='Run the command in this process even if a daemon is running'
+  ),
+  parser.add_argument(
+      '--stats',
+      action='store_true',
+      help='Print the time spent loading, validating and writing bookmarks, with request latencies'
+  ),
+  parser.add_argument(
+      '--metrics',
+      action='store',
+      metavar='FILE',
+      help='Write timers, counters and request latency histograms to a json file'
+  ),
   parser.add_argument(
       '-i',
       '--import',
       action='store',
-      nargs=2,
-      help="""Import bookmarks from:
+      nargs='+',
+      metavar=('TYPE', 'FILE'),
+      help="""Import bookmarks from one or more files of type:
     nbff: Netscape Bookmark File format
     insta: Instapaper"""
   ),
+  parser.add_argument(
+      '-b',
+      '--batch',
+      action='store',
+      metavar='FILE',
+      help="""Apply the commands in FILE (- for stdin), one per line, saving them together:
+    add URL [TAGS]: add url and tags, or add tags if url exists
+    delete URL [TAG]: delete url, or tag if provided
+    title URL TITLE: set the title of url
+Titles of added urls are fetched concurrently, arguments with spaces can be quoted"""
+  ),
+  parser.add_argument(
+      '--rollback',
+      action='store_true',
+      help='Save no changes of a batch if any of its commands fails'
+  ),
   parser.add_argument(
       '-a',
       '--add',
@@ -258,7 +596,22 @@ def get_parser():
 if __name__ == "__main__":
   parser = get_parser()
   args = vars(parser.parse_args())
+  if args['daemon']:
+    serve()
+    sys.exit()
+  data = {"argv": sys.argv[1:], "cwd": os.getcwd()}
+  if args['batch'] == '-':
+    # the daemon can't read our stdin, commands are sent with the request
+    data['stdin'] = sys.stdin.read()
+    sys.stdin = io.StringIO(data['stdin'])
+  response = None if args['local'] else daemon.request(daemon_fpath, data)
+  if response is not None:
+    print(response['output'], end='')
+    if response['error']:
+      print(response['error'], file=sys.stderr)
+      sys.exit(1)
+    sys.exit()
   try:
-    main(args)
+    run(args)
   except Exception as e:
     logger.exception(e)
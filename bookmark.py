@@ -1,54 +1,93 @@
+import os
 import re
+import sys
 import csv
 import json
+import time
 import uuid
 import logging
-from http.client import responses
+from http import HTTPStatus
 from datetime import datetime
+from itertools import count, repeat
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-import cgi
-import bs4
-import requests
-from tld import get_fld, get_tld
-
+from modules import web
+from modules import nbff
+from modules import dedup
 from modules import utils
+from modules.journal import Journal
+from modules.metrics import metrics
+from modules.jsonstream import JsonArrayReader
+from bookmarkdb import BookmarkDatabase
+from bookmarksearch import BookmarkSearchIndex
+from bookmarksnapshots import BookmarkSnapshotStore
 
 
 logger = logging.getLogger('bkm-org')
 date_format = '%Y-%m-%d'
 datetime_format = '%Y-%m-%d %H:%M:%S'
+uuid_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def parse_datetime(string):
+  # fast path for datetime_format, strptime is too slow for large collections
+  if len(string) == 19 and string[4] == '-' and string[7] == '-' and string[10] == ' ' and string[13] == ':' and string[16] == ':':
+    try:
+      return datetime(int(string[:4]), int(string[5:7]), int(string[8:10]), int(string[11:13]), int(string[14:16]), int(string[17:]))
+    except ValueError:
+      pass
+  return datetime.strptime(string, datetime_format)
 
 
 class Bookmark:
 
-  statusd = responses.copy()
+  __slots__ = ['_id', 'url', 'title', 'mtype', 'created', 'tags', 'categories', 'vtypes', 'lrequest', 'history']
+
+  statusd = {s.value: s.phrase for s in HTTPStatus}
   statusd[0] = 'Connection Failed'
   statusd[10] = 'Unknown'
 
+  title_max_bytes = 512 * 1024
+  # html bodies kept as snapshots are cut after this size
+  page_max_bytes = 2 * 1024 * 1024
+
+  # shared by all bookmarks, replaced (never mutated) when a bookmark has its own
+  default_vtypes = ('connection', 'url', 'title')
+  empty_history = ()
+
   def __init__(self, url='', title='', created=None, tags=None, categories=''):
-    self.id = uuid.uuid4()
+    self._id = str(uuid.uuid4())
     self.url = url
     self.title = title
     self.mtype = 'unknown'
     self.created = created if created else datetime.now()
     self.tags = tags if tags else []
     self.categories = categories
-    self.vtypes = ['connection', 'url', 'title']
+    self.vtypes = self.default_vtypes
     self.lrequest = None
-    self.history = []
+    self.history = self.empty_history
+
+  @property
+  def id(self):
+    return uuid.UUID(self._id)
+
+  @id.setter
+  def id(self, value):
+    self._id = str(value)
 
   def parse_json(self, data):
-    self.id = uuid.UUID(data['id'])
+    self._id = data['id'] if uuid_pattern.fullmatch(data['id']) else str(uuid.UUID(data['id']))
     self.url = data['url']
     self.title = data['title']
     if 'mediaType' in data:
-      self.mtype = data['mediaType']
-    self.created = datetime.strptime(data['created'], datetime_format)
-    self.tags = data['tags']
-    self.categories = data['categories']
+      self.mtype = sys.intern(data['mediaType'])
+    self.created = parse_datetime(data['created'])
+    self.tags = [sys.intern(t) for t in data['tags']]
+    self.categories = sys.intern(data['categories'])
     if 'validation' in data:
-      self.vtypes = data['validation']['types']
+      vtypes = data['validation']['types']
+      self.vtypes = self.default_vtypes if tuple(vtypes) == self.default_vtypes else vtypes
       if 'lastHttpRequest' in data['validation']:
         self.lrequest = LastHttpRequest(False)
         self.lrequest.parse(data['validation']['lastHttpRequest'])
@@ -65,75 +104,178 @@ class Bookmark:
   @property
   def json(self):
     data = {}
-    data["id"] = str(self.id)
+    data["id"] = self._id
     data["url"] = self.url
     data["title"] = self.title
     data["mediaType"] = self.mtype
     data["created"] = self.created.strftime(datetime_format)
     data["tags"] = self.tags
     data["categories"] = self.categories
-    data["validation"] = {"types": self.vtypes}
+    data["validation"] = {"types": list(self.vtypes)}
     if self.lrequest:
       data["validation"]["lastHttpRequest"] = self.lrequest.json
     if self.history:
-      data["history"] = self.history
+      data["history"] = list(self.history)
     return data
 
-  def verify(self):
+  @metrics.timed('verify', histogram=True)
+  def verify(self, session=None, snapshots=None):
+    # html pages whose title is needed are requested with a GET, others with a HEAD first. A streamed
+    # GET is sent when the HEAD request fails once connected, is rejected or finds an html page to
+    # read the title of. A host that can't be reached is not requested again
+    previous = self.lrequest
+    response = None
     try:
-      response = requests.get(self.url, timeout=(2, 10))
-    except Exception as e:
+      if self.mtype != 'text/html' or 'title' not in self.vtypes:
+        response = self._request('HEAD', session)
+        if response is not None and (response.status_code >= 400 or response.status_code != 304 and self._reads_body(response)):
+          if response.status_code >= 400:
+            metrics.count('verify.head_rejected')
+          response.close()
+          response = None
+      if response is None:
+        response = self._request('GET', session)
+    except Exception:
+      response = None
+    if response is None:
       self.lrequest = LastHttpRequest(False)
+      metrics.count('verify.connection_failed')
       logger.error(f"error connecting to: {self.url}")
-      logger.debug(e)
       return False
 
+    with response:
+      verified = self._verify_response(response, previous, snapshots)
+      # only bodies read count, the connection is closed without reading the rest
+      self.lrequest.transferred = response.raw.tell()
+      metrics.count('verify.bytes', self.lrequest.transferred)
+      return verified
+
+  def _request(self, method, session=None):
+    request = session.request if session else web.request
+    try:
+      return request(method, self.url, headers=self.conditional_headers, timeout=(2, 10), stream=True, allow_redirects=True)
+    except Exception as e:
+      logger.debug(f"{method} request to '{self.url}' failed")
+      logger.debug(e)
+      if web.is_unreachable(e): raise
+      return None
+
+  def _reads_body(self, response):
+    # only html pages have their body read, for their title
+    mtype = web.get_media_type(response)
+    return 'title' in self.vtypes and (self.mtype or mtype) == 'text/html' and mtype in [None, 'text/html']
+
+  @property
+  def conditional_headers(self):
+    headers = {}
+    if self.lrequest and self.lrequest.connected and self.lrequest.status == 200:
+      if self.lrequest.etag:
+        headers['If-None-Match'] = self.lrequest.etag
+      if self.lrequest.modified:
+        headers['If-Modified-Since'] = self.lrequest.modified
+    return headers
+
+  def _verify_response(self, response, previous=None, snapshots=None):
     self.lrequest = LastHttpRequest(True, response.status_code)
+    self.lrequest.etag = response.headers.get('etag', None)
+    self.lrequest.modified = response.headers.get('last-modified', None)
 
     # get redirect url
     if 'url' in self.vtypes and response.url != self.url:
       self.lrequest.redirect = response.url
 
-    ctype = response.headers.get('content-type', None)
-    if ctype:
+    # page not modified since the last request, keep its status, title and media type
+    if response.status_code == 304 and previous:
+      self.lrequest.status = previous.status
+      self.lrequest.title = previous.title
+      self.lrequest.etag = self.lrequest.etag or previous.etag
+      self.lrequest.modified = self.lrequest.modified or previous.modified
+      # the snapshot stored with the validator the server just confirmed is still the page, it has the current title
+      validator = previous.etag or previous.modified
+      page = snapshots.get(self._id, validator) if snapshots and validator else None
+      if page is not None and 'title' in self.vtypes:
+        t = parse_title(*page)
+        self.lrequest.title = t if self.title != t else None
+      return True
+
+    mtype = web.get_media_type(response)
+    if mtype:
       if not self.mtype:
-        self.mtype = cgi.parse_header(ctype)[0]
+        self.mtype = mtype
     else:
       logger.debug(f"not able to get content-type for '{self.url}'")
 
-    if self.mtype != 'text/html': return True
+    if not self._reads_body(response): return True
 
     # get title
-    if 'title' in self.vtypes:
-      t = self.fetch_title(response)
-      if self.title != t:
-        self.lrequest.title = t
+    t = self.fetch_title(response, snapshots=snapshots)
+    if self.title != t:
+      self.lrequest.title = t
 
     return True
 
-  def update_url(self, url):
-    self.history.append({"date": datetime.now().strftime(datetime_format), "url": self.url})
+  def copy_verification(self, source, redirect=None):
+    # reuse the last request of a bookmark for the same page instead of requesting it again
+    lrequest = source.lrequest
+    self.lrequest = LastHttpRequest(lrequest.connected, lrequest.status, etag=lrequest.etag, modified=lrequest.modified, date=lrequest.date)
+    if not lrequest.connected: return
+
+    if 'url' in self.vtypes and redirect and redirect != self.url:
+      self.lrequest.redirect = redirect
+
+    if not self.mtype:
+      self.mtype = source.mtype
+
+    if self.mtype != 'text/html' or source.mtype != 'text/html': return
+
+    # the source only keeps the page title when it differs from its own (None when they are equal),
+    # a page without a title has ''
+    if 'title' in self.vtypes and 'title' in source.vtypes:
+      title = source.title if lrequest.title is None else lrequest.title
+      if self.title != title:
+        self.lrequest.title = title
+
+  def update_url(self, url, date=None):
+    date = date if date else datetime.now().strftime(datetime_format)
+    self.history = [*self.history, {"date": date, "url": self.url}]
     self.url = url
 
-  def update_title(self, title):
-    self.history.append({"date": datetime.now().strftime(datetime_format), "title": self.title})
+  def update_title(self, title, date=None):
+    date = date if date else datetime.now().strftime(datetime_format)
+    self.history = [*self.history, {"date": date, "title": self.title}]
     self.title = title
 
-  def fetch_title(self, response=None):
-    if not response:
+  @metrics.timed('fetch_title')
+  def fetch_title(self, response=None, session=None, snapshots=None):
+    if response is None:
+      get = session.get if session else web.get
       try:
-        response = requests.get(self.url, timeout=(2, 10))
+        response = get(self.url, timeout=(2, 10), stream=True)
       except Exception as e:
         logger.debug(f"not able to get response from '{self.url}' to fecth title")
         logger.debug(e)
         return ''
+      with response:
+        return self.fetch_title(response, snapshots=snapshots)
 
-    html = bs4.BeautifulSoup(response.text, 'html.parser')
-    if response.status_code == 200 and html.title:
-      return html.title.text.strip()
-    else:
+    if response.status_code != 200: return ''
+
+    # only the beginning of the page is downloaded, up to the end of the title, unless it is kept
+    try:
+      if snapshots:
+        html = web.read_body(response, self.page_max_bytes)
+      else:
+        html = web.read_head(response, self.title_max_bytes)
+    except Exception as e:
+      logger.debug(f"not able to read response from '{self.url}' to fecth title")
+      logger.debug(e)
       return ''
 
+    if snapshots:
+      validator = response.headers.get('etag') or response.headers.get('last-modified')
+      snapshots.put(self._id, self.url, html, response.encoding, validator)
+    return parse_title(html, response.encoding)
+
   def add_tags(self, tags):
     at_least_one_tag_added = False
     for tag in tags:
@@ -156,30 +298,365 @@ class Bookmark:
       code = 0
     else:
       code = self.lrequest.status
-    status_name = self.statusd[code] if code in self.statusd else 'Unknown Status Code'
-    return {"code": code, "name": status_name}
+    return {"code": code, "name": self.get_status_name(code)}
+
+  @classmethod
+  def get_status_name(cls, code):
+    return cls.statusd[code] if code in cls.statusd else 'Unknown Status Code'
 
 
 class BookmarkCollection:
 
   ignore_titles = ['Untitled', '']
-
-  def __init__(self, fpath=None, name='', description='', catalog='default'):
+  journal_max_bytes = 1024 * 1024
+  # validation results are saved after this many bookmarks or seconds, whichever comes first
+  checkpoint_every = 100
+  checkpoint_seconds = 60
+  # size of the compressed page snapshots kept next to the collection file, 0 keeps none
+  snapshots_max_bytes = 0
+  # query parameters left out of canonical urls, canonical_urls = False only matches exact urls
+  canonical_urls = True
+  canonical_ignore_params = ['utm_*']
+
+  def __init__(self, fpath=None, name='', description='', catalog='default', lazy=False):
     self.name = name
     self.description = description
     self.catalog = catalog
     self.bookmarks = []
+    # full-text index kept up to date with the collection, once opened
+    self.search_index = None
+    self.snapshots = None
+    self.reindex()
     self.fpath = fpath
+    self.lazy = False
+    self.db = None
+    self.report = None
+    # changes not yet saved to the journal (or database), None when only a full write can save them
+    self.changes = []
     if fpath and fpath.exists():
-      self.load(fpath)
+      if lazy and (fpath.suffix == '.db' or fpath.suffix == '.json' and not self.journal.size):
+        self.load_header(fpath)
+      else:
+        self.load(fpath)
+
+  def __iter__(self):
+    # lazy collections stream their bookmarks from file, one at a time, until loaded
+    if not self.lazy:
+      yield from self.bookmarks
+      return
+    for bjson in self._iter_file():
+      yield self._parse_bookmark(bjson)
+
+  def _parse_bookmark(self, bjson):
+    bookmark = Bookmark()
+    bookmark.parse_json(bjson)
+    return bookmark
+
+  def _iter_file(self):
+    if self.db:
+      yield from self.db.iter_bookmarks()
+      return
+    with open(self.fpath, encoding='utf-8') as file:
+      yield from JsonArrayReader(file, 'bookmarks')
+
+  def reindex(self):
+    self.url_index = defaultdict(list)
+    self.title_index = defaultdict(list)
+    self.hurl_index = defaultdict(list)
+    self.htitle_index = defaultdict(list)
+    # insertion order, used to resolve lookups matching several bookmarks like a list scan would
+    self.order = {}
+    self.counter = count()
+    # built on the first listing query, then kept up to date
+    self.attr_index = None
+    self.attr_keys = {}
+    # built on the first canonical url lookup, then kept up to date
+    self.key_index = None
+    self.url_keys = {}
+    for b in self.bookmarks:
+      self.order[b] = next(self.counter)
+      self._index(b)
+
+  def _index(self, bookmark):
+    if self.search_index:
+      self.search_index.add(bookmark)
+    self._index_keys(bookmark)
+    self.url_index[bookmark.url].append(bookmark)
+    self.title_index[bookmark.title].append(bookmark)
+    for h in bookmark.history:
+      if 'url' in h:
+        self.hurl_index[h['url']].append(bookmark)
+      if 'title' in h:
+        self.htitle_index[h['title']].append(bookmark)
+
+  def _unindex(self, bookmark):
+    if self.search_index:
+      self.search_index.remove(bookmark)
+    self._unindex_keys(bookmark)
+    self._unindex_key(self.url_index, bookmark.url, bookmark)
+    self._unindex_key(self.title_index, bookmark.title, bookmark)
+    for h in bookmark.history:
+      if 'url' in h:
+        self._unindex_key(self.hurl_index, h['url'], bookmark)
+      if 'title' in h:
+        self._unindex_key(self.htitle_index, h['title'], bookmark)
+
+  def _unindex_key(self, index, key, bookmark):
+    bookmarks = index.get(key)
+    if not bookmarks: return
+    for i, b in enumerate(bookmarks):
+      if b is bookmark:
+        del bookmarks[i]
+        break
+    if not bookmarks:
+      del index[key]
+
+  def canonical_key(self, url):
+    if not self.canonical_urls: return url
+    return web.canonicalize_url(url, self.canonical_ignore_params)
+
+  def _url_keys(self, bookmark):
+    # only the bookmark url, the url it last redirected to is a different page to add, find or change.
+    # Redirect targets only group bookmarks requested once in validate
+    return [self.canonical_key(bookmark.url)]
+
+  def _index_keys(self, bookmark):
+    if self.key_index is None: return
+    keys = self._url_keys(bookmark)
+    self.url_keys[bookmark] = keys
+    for key in keys:
+      self.key_index[key].append(bookmark)
+
+  def _unindex_keys(self, bookmark):
+    if self.key_index is None: return
+    for key in self.url_keys.pop(bookmark, []):
+      self._unindex_key(self.key_index, key, bookmark)
+
+  def _get_key_index(self):
+    if self.key_index is None:
+      self.key_index = defaultdict(list)
+      for b in self.bookmarks:
+        self._index_keys(b)
+    return self.key_index
+
+  def _attr_keys(self, bookmark):
+    return {
+        'status': [bookmark.status['code']],
+        'tag': list(bookmark.tags),
+        'created': [bookmark.created.strftime(date_format)],
+        'domain': [web.get_domain(bookmark.url)],
+        'media': [bookmark.mtype]
+    }
+
+  def _index_attrs(self, bookmark):
+    if self.attr_index is None: return
+    keys = self._attr_keys(bookmark)
+    self.attr_keys[bookmark] = keys
+    for by, values in keys.items():
+      for value in values:
+        # dicts used as ordered sets
+        self.attr_index[by][value][bookmark] = None
+
+  def _unindex_attrs(self, bookmark):
+    if self.attr_index is None: return
+    keys = self.attr_keys.pop(bookmark, {})
+    for by, values in keys.items():
+      for value in values:
+        bookmarks = self.attr_index[by].get(value)
+        if bookmarks is None: continue
+        bookmarks.pop(bookmark, None)
+        if not bookmarks:
+          del self.attr_index[by][value]
+
+  def refresh(self, bookmark):
+    # update the listing indexes after changing a bookmark's tags, url, created date or last request
+    self._unindex_attrs(bookmark)
+    self._index_attrs(bookmark)
+    self._unindex_keys(bookmark)
+    self._index_keys(bookmark)
+
+  def _get_attr_index(self, by):
+    if self.attr_index is None:
+      self.attr_index = {k: defaultdict(dict) for k in ['status', 'tag', 'created', 'domain', 'media']}
+      for b in self.bookmarks:
+        self._index_attrs(b)
+    return self.attr_index[by]
+
+  def _sorted(self, bookmarks):
+    return sorted(bookmarks, key=self.order.get)
+
+  def _set_collection(self, bc):
+    self.name = bc.name
+    self.description = bc.description
+    self.catalog = bc.catalog
+    self.bookmarks = bc.bookmarks
+    self.url_index = bc.url_index
+    self.title_index = bc.title_index
+    self.hurl_index = bc.hurl_index
+    self.htitle_index = bc.htitle_index
+    self.order = bc.order
+    self.counter = bc.counter
+    self.attr_index = bc.attr_index
+    self.attr_keys = bc.attr_keys
+    self.key_index = bc.key_index
+    self.url_keys = bc.url_keys
+    if self.search_index:
+      self.search_index.stale = True
+
+  @property
+  def journal(self):
+    return Journal(self.fpath.with_suffix('.journal')) if self.fpath else None
+
+  @property
+  def checkpoint_fpath(self):
+    # start date of a checkpointed validation, removed once it finishes
+    return self.fpath.with_suffix('.validation') if self.fpath else None
+
+  def _read_checkpoint(self):
+    fpath = self.checkpoint_fpath
+    if not fpath or not fpath.exists(): return None
+    with open(fpath, encoding='utf-8') as file:
+      return parse_datetime(json.load(file)['started'])
+
+  def _write_checkpoint(self, started):
+    with utils.atomic_open(self.checkpoint_fpath) as file:
+      json.dump({"started": started.strftime(datetime_format)}, file)
+
+  @property
+  def search_fpath(self):
+    return self.fpath.with_suffix('.search') if self.fpath else ':memory:'
+
+  @property
+  def snapshots_fpath(self):
+    return self.fpath.with_suffix('.snapshots') if self.fpath else None
+
+  def open_snapshots(self):
+    # page snapshots are only kept for collections saved to a file
+    if self.snapshots is None and self.snapshots_max_bytes and self.fpath:
+      self.snapshots = BookmarkSnapshotStore(self.snapshots_fpath, self.snapshots_max_bytes)
+    return self.snapshots
+
+  def files_stamp(self):
+    # modification time and size of the files holding the collection
+    files = [self.fpath] if self.db else [self.fpath, self.journal.fpath]
+    return [[f.stat().st_mtime_ns, f.stat().st_size] if f.exists() else None for f in files]
+
+  def _open_search_index(self):
+    # an index is only kept up to date if it matches the collection files, others are rebuilt on search
+    if self.search_index or not self.fpath.with_suffix('.search').exists(): return
+    index = BookmarkSearchIndex(self.search_fpath)
+    if index.is_current(self.files_stamp()):
+      self.search_index = index
+    else:
+      index.close()
+
+  def _commit_search(self):
+    if self.search_index and self.fpath:
+      self.search_index.commit(self.files_stamp())
+
+  def _clear_checkpoint(self):
+    fpath = self.checkpoint_fpath
+    if fpath and fpath.exists():
+      fpath.unlink()
+
+  def _record(self, op, **data):
+    if self.changes is not None:
+      self.changes.append({"op": op, **data})
+
+  def _replay(self, journal):
+    changes = self.changes
+    self.changes = None
+    for entry in journal.read():
+      op = entry['op']
+      if op == 'add':
+        bookmark = Bookmark()
+        bookmark.parse_json(entry['bookmark'])
+        self.add(bookmark)
+      elif op == 'delete':
+        self.delete_url(entry['url'])
+      elif op == 'add_tags':
+        self.add_tags(entry['url'], entry['tags'])
+      elif op == 'delete_tag':
+        self.delete_tag(entry['url'], entry['tag'])
+      elif op in ['update_url', 'update_title', 'verify']:
+        bookmark = self.find_by_url(entry['url'])
+        if not bookmark:
+          logger.debug(f"not able to replay {op}: {entry['url']}")
+        elif op == 'update_url':
+          self.update_url(bookmark, entry['new_url'], entry['date'])
+        elif op == 'update_title':
+          self.update_title(bookmark, entry['title'], entry['date'])
+        else:
+          bookmark.mtype = entry['mtype']
+          bookmark.lrequest = None
+          if entry['lrequest']:
+            bookmark.lrequest = LastHttpRequest(False)
+            bookmark.lrequest.parse(entry['lrequest'])
+          self.refresh(bookmark)
+    self.changes = changes
+
+  def save(self, compact=False):
+    if self.changes is None or compact:
+      self.compact()
+    elif self.db:
+      for change in self.changes:
+        self.db.apply(change)
+      self.changes = []
+    elif self.journal.size > self.journal_max_bytes:
+      self.compact()
+    else:
+      self.journal.append(self.changes)
+      self.changes = []
+    self._commit_search()
+
+  def compact(self):
+    self.write()
+
+  def _is_collection_file(self, fpath):
+    # the same file may be given as a relative and an absolute path
+    return bool(self.fpath) and fpath.resolve() == self.fpath.resolve()
+
+  def _saved(self, fpath):
+    # a full write to the collection file saves every pending and journaled change
+    if self._is_collection_file(fpath):
+      self.journal.clear()
+      self.changes = []
+      self._commit_search()
 
   def add(self, bookmark):
-    found = self.find_by_url(bookmark.url)
+    found = self.find_by_canonical_url(bookmark.url)
     if not found:
-      self.bookmarks.append(bookmark)
+      self._append(bookmark)
       return True
     return False
 
+  def add_many(self, bookmarks, match_titles=False, merge=False, exact=False):
+    # bookmarks are checked against the collection and the ones already added from the batch
+    summary = {"added": 0, "merged": 0, "skipped": 0}
+    for bookmark in bookmarks:
+      if match_titles:
+        found = self.find(bookmark.url, bookmark.title)
+      else:
+        found = self.find_by_url(bookmark.url) if exact else self.find_by_canonical_url(bookmark.url)
+      if not found:
+        self._append(bookmark)
+        summary['added'] += 1
+      elif merge and bookmark.created < found.created:
+        found.created = bookmark.created
+        self.refresh(found)
+        summary['merged'] += 1
+      else:
+        summary['skipped'] += 1
+    return summary
+
+  def _append(self, bookmark):
+    self.bookmarks.append(bookmark)
+    self.order[bookmark] = next(self.counter)
+    self._index(bookmark)
+    self._index_attrs(bookmark)
+    if self.changes is not None:
+      self._record('add', bookmark=bookmark.json)
+
   def delete(self, bookmark):
     return self.delete_url(bookmark.url)
 
@@ -194,29 +671,100 @@ class BookmarkCollection:
     return self.add(bookmark)
 
   def delete_url(self, url):
-    found = self.find_by_url(url)
+    # like add, urls match the bookmarks sharing their canonical url, the journal keeps the stored one
+    found = self.find_by_canonical_url(url)
     if found:
       self.bookmarks.remove(found)
+      self._unindex(found)
+      self._unindex_attrs(found)
+      del self.order[found]
+      self._record('delete', url=found.url)
       return True
     return False
 
+  def delete_bookmarks(self, bookmarks):
+    # deletes in a single pass over the collection instead of one list scan per bookmark
+    deleted = {b: None for b in bookmarks if b in self.order}
+    if not deleted: return []
+    self.bookmarks[:] = [b for b in self.bookmarks if b not in deleted]
+    for b in deleted:
+      self._unindex(b)
+      self._unindex_attrs(b)
+      del self.order[b]
+      self._record('delete', url=b.url)
+    return list(deleted)
+
+  def update_url(self, bookmark, url, date=None):
+    old_url = bookmark.url
+    self._unindex(bookmark)
+    bookmark.update_url(url, date)
+    self._index(bookmark)
+    self.refresh(bookmark)
+    self._record('update_url', url=old_url, new_url=url, date=bookmark.history[-1]['date'])
+
+  def update_title(self, bookmark, title, date=None):
+    self._unindex(bookmark)
+    bookmark.update_title(title, date)
+    self._index(bookmark)
+    self._record('update_title', url=bookmark.url, title=title, date=bookmark.history[-1]['date'])
+
+  def set_title(self, bookmark, title):
+    self._unindex_key(self.title_index, bookmark.title, bookmark)
+    bookmark.title = title
+    self.title_index[title].append(bookmark)
+    if self.search_index:
+      self.search_index.update(bookmark)
+
   def add_tags(self, url, tags):
-    bookmark = self.find_by_url(url)
-    if bookmark:
-      return bookmark.add_tags(tags)
+    bookmark = self.find_by_canonical_url(url)
+    if bookmark and bookmark.add_tags(tags):
+      self.refresh(bookmark)
+      if self.search_index:
+        self.search_index.update(bookmark)
+      self._record('add_tags', url=bookmark.url, tags=tags)
+      return True
     return False
 
   def delete_tag(self, url, tag):
-    bookmark = self.find_by_url(url)
-    if bookmark:
-      return bookmark.delete_tag(tag)
+    bookmark = self.find_by_canonical_url(url)
+    if bookmark and bookmark.delete_tag(tag):
+      self.refresh(bookmark)
+      if self.search_index:
+        self.search_index.update(bookmark)
+      self._record('delete_tag', url=bookmark.url, tag=tag)
+      return True
     return False
 
+  def load_header(self, fpath):
+    self.fpath = fpath
+    self.lazy = True
+    if fpath.suffix == '.db':
+      self.db = BookmarkDatabase(fpath)
+      header = self.db.read_header()
+      self.name = header['name']
+      self.description = header['description']
+      self.catalog = header['catalog']
+    else:
+      with open(fpath, encoding='utf-8') as file:
+        reader = JsonArrayReader(file, 'bookmarks')
+        if not all(k in reader.header for k in ['name', 'description', 'catalog']):
+          for _ in reader: pass
+        self.name = reader.header['name']
+        self.description = reader.header['description']
+        self.catalog = reader.header['catalog']
+    self._open_search_index()
+
+  @metrics.timed('load')
   def load(self, fpath):
     self.fpath = fpath
+    self.lazy = False
+
+    if fpath.suffix == '.db':
+      self.load_db(fpath)
+      return
 
     if fpath.suffix == '.json':
-      get_data = lambda f: json.load(f)
+      get_data = lambda f: JsonArrayReader(f, 'bookmarks')
     elif fpath.suffix == '.md':
       get_data = lambda f: f.readlines()
     else:
@@ -224,71 +772,120 @@ class BookmarkCollection:
 
     with open(fpath, encoding='utf-8') as file:
       data = get_data(file)
-      bcp = BookmarkCollectionParser(fpath.suffix[1:], self.bookmarks)
+      bcp = BookmarkCollectionParser(fpath.suffix[1:], self.bookmarks, self.name, self.description, self.catalog)
       parsedbc = bcp.parse(data)
-      self.name = parsedbc.name
-      self.description = parsedbc.description
-      self.catalog = parsedbc.catalog
-      self.bookmarks = parsedbc.bookmarks
+      self._set_collection(parsedbc)
+      self.report = parsedbc.report
+
+    if fpath.suffix == '.json':
+      self.changes = []
+      self._replay(self.journal)
+    else:
+      self.changes = None
+    self._open_search_index()
+
+  def load_db(self, fpath):
+    self.fpath = fpath
+    self.lazy = False
+    self.db = BookmarkDatabase(fpath)
+    bcp = BookmarkCollectionParser('db', self.bookmarks, **self.db.read_header())
+    parsedbc = bcp.parse(self.db.iter_bookmarks())
+    self._set_collection(parsedbc)
+    self.changes = []
+    self._open_search_index()
 
   def import_md(self):
-    self.load(self.fpath.with_suffix('.md'))
+    fpath = self.fpath
+    self.load(fpath.with_suffix('.md'))
+    self.fpath = fpath
+    return self.report
 
   def import_nbff(self, fpath):
-    with open(fpath, encoding='utf-8') as file:
-      data = bs4.BeautifulSoup(file, 'html.parser')
-    bcp = BookmarkCollectionParser('nbff', self.bookmarks)
-    parsedbc = bcp.import_nbff(data)
-    self.name = parsedbc.name
-    self.description = parsedbc.description
-    self.catalog = parsedbc.catalog
-    self.bookmarks = parsedbc.bookmarks
+    return self.import_files('nbff', [fpath])
 
   def import_instapaper(self, fpath):
-    with open(fpath, encoding='utf-8') as csv_file:
-      reader = csv.DictReader(csv_file)
-      bcp = BookmarkCollectionParser('insta', self.bookmarks)
-      parsedbc = bcp.import_instapaper(reader)
-      self.name = parsedbc.name
-      self.description = parsedbc.description
-      self.catalog = parsedbc.catalog
-      self.bookmarks = parsedbc.bookmarks
+    return self.import_files('insta', [fpath])
+
+  def import_files(self, itype, fpaths, workers=None):
+    # files are parsed in parallel, then merged into the collection in order. A single worker
+    # streams each file into the collection without building its list of bookmarks
+    if itype not in importers:
+      raise ValueError(f"cannot import bookmarks of type '{itype}'")
+    parse, options = importers[itype]
+    self.changes = None
+
+    workers = min(workers or os.cpu_count() or 1, len(fpaths))
+    if workers < 2:
+      parsed = map(parse, fpaths)
+    else:
+      from concurrent.futures import ProcessPoolExecutor
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(parse_file, repeat(itype), fpaths))
+
+    summary = {"added": 0, "merged": 0, "skipped": 0}
+    for fpath, bookmarks in zip(fpaths, parsed):
+      for k, v in self.add_many(bookmarks, **options).items():
+        summary[k] += v
+    return summary
 
   def write(self, fpath=None):
-    if not fpath and self.fpath:
-      fpath = self.fpath
-    elif not self.fpath:
+    if not fpath and not self.fpath:
       raise ValueError("no file path to write to defined")
+    fpath = fpath if fpath else self.fpath
 
     if fpath.suffix == '.json':
       self.write_json(fpath)
     elif fpath.suffix == '.md':
       self.write_md(fpath)
+    elif fpath.suffix == '.db':
+      self.write_db(fpath)
     else:
       raise ValueError(f"cannot handle file with extension '{fpath.suffix}'")
 
+  @metrics.timed('write.json')
   def write_json(self, fpath=None):
-    if not fpath and self.fpath:
-      fpath = self.fpath.with_suffix('.json')
-    elif not self.fpath:
+    if self.lazy:
+      raise ValueError("cannot write a collection that has not been loaded")
+    if not fpath and not self.fpath:
       raise ValueError("no file path to write to defined")
+    fpath = fpath if fpath else self.fpath.with_suffix('.json')
 
-    with open(fpath, 'w', encoding='utf8') as wf:
+    with utils.atomic_open(fpath) as wf:
       json.dump(self.json, wf, indent=2, ensure_ascii=False)
       wf.write('\n')
+    self._saved(fpath)
 
+  @metrics.timed('write.md')
   def write_md(self, fpath=None):
-    if not fpath and self.fpath:
-      fpath = self.fpath.with_suffix('.md')
-    elif not self.fpath:
+    if self.lazy:
+      raise ValueError("cannot write a collection that has not been loaded")
+    if not fpath and not self.fpath:
       raise ValueError("no file path to write to defined")
+    fpath = fpath if fpath else self.fpath.with_suffix('.md')
 
-    with open(fpath, 'w', encoding='utf8') as wf:
+    with utils.atomic_open(fpath) as wf:
       wf.write(f'{self.md}\n')
+    self._saved(fpath)
+
+  @metrics.timed('write.db')
+  def write_db(self, fpath=None):
+    if self.lazy:
+      raise ValueError("cannot write a collection that has not been loaded")
+    if not fpath and not self.fpath:
+      raise ValueError("no file path to write to defined")
+    fpath = fpath if fpath else self.fpath.with_suffix('.db')
+
+    db = self.db if self.db and fpath.resolve() == self.db.fpath.resolve() else BookmarkDatabase(fpath)
+    header = {"name": self.name, "description": self.description, "catalog": self.catalog}
+    db.replace_all(header, (b.json for b in sorted(self.bookmarks, key=lambda b: b.created, reverse=True)))
+    if self._is_collection_file(fpath):
+      self.db = db
+    self._saved(fpath)
 
   def find(self, url, title=None):
     bookmark = self.find_by_url(url)
     if not bookmark: bookmark = self.find_by_url_in_history(url)
+    if not bookmark: bookmark = self.find_by_canonical_url(url)
     if not title: return bookmark
     if not bookmark: bookmark = self.find_by_title(title)
     if not bookmark: bookmark = self.find_by_title_in_history(title)
@@ -298,34 +895,36 @@ class BookmarkCollection:
     bookmark = self.find_by_url(url)
     bookmark = bookmark if bookmark else self.find_by_url_in_history(url)
     if bookmark:
-      bookmark.title = title
+      self.set_title(bookmark, title)
     return bookmark
 
   def find_by_url(self, url):
-    return next((b for b in self.bookmarks if b.url == url), None)
+    return self._first(self.url_index, url)
+
+  def find_by_canonical_url(self, url):
+    # exact matches first, then any bookmark sharing the canonical url
+    bookmark = self.find_by_url(url)
+    if bookmark: return bookmark
+    return self._first(self._get_key_index(), self.canonical_key(url))
 
   def find_by_title(self, title):
     if title in self.ignore_titles: return None
-    return next((b for b in self.bookmarks if b.title == title), None)
+    return self._first(self.title_index, title)
 
   def find_by_url_in_history(self, url):
-    for b in self.bookmarks:
-      if not b.history: continue
-      for h in b.history:
-        if 'url' in h and h['url'] == url:
-          return b
-    return None
+    return self._first(self.hurl_index, url)
 
   def find_by_title_in_history(self, title):
     if title in self.ignore_titles: return None
-    for b in self.bookmarks:
-      if not b.history: continue
-      for h in b.history:
-        if 'title' in h and h['title'] == title:
-          return b
-    return None
+    return self._first(self.htitle_index, title)
+
+  def _first(self, index, key):
+    bookmarks = index.get(key)
+    if not bookmarks: return None
+    return bookmarks[0] if len(bookmarks) == 1 else min(bookmarks, key=self.order.get)
 
   @property
+  @metrics.timed('collection.json')
   def json(self):
     data = {
         "name": self.name,
@@ -338,6 +937,7 @@ class BookmarkCollection:
     return data
 
   @property
+  @metrics.timed('collection.md')
   def md(self):
     lines = []
     cats = []
@@ -350,59 +950,285 @@ class BookmarkCollection:
       lines.append(bk.md)
     return '\n'.join(lines)
 
-  def validate(self):
+  @metrics.timed('validate')
+  def validate(self, workers=1, host_workers=2, ttl=None, host_failures=5, checkpoint=False, resume=False):
+    # with checkpoint, results are saved while validating and resume skips the bookmarks
+    # already validated by the last interrupted run
+    since = self._read_checkpoint() if resume else None
+    if since:
+      logger.info(f'resuming validation started at {since}')
+    if checkpoint:
+      self._write_checkpoint(since or datetime.now().replace(microsecond=0))
+
+    unsaved = 0
+    saved_at = time.monotonic()
+    # html pages requested for their titles are also kept as snapshots, when enabled
+    self.open_snapshots()
+
+    def validated(bookmarks):
+      nonlocal unsaved, saved_at
+      for b in bookmarks:
+        self.refresh(b)
+        self._record('verify', url=b.url, mtype=b.mtype, lrequest=b.lrequest.json if b.lrequest else None)
+      unsaved += len(bookmarks)
+      if checkpoint and (unsaved >= self.checkpoint_every or time.monotonic() - saved_at >= self.checkpoint_seconds):
+        self.save()
+        unsaved, saved_at = 0, time.monotonic()
+
+    bookmarks = []
     for b in self.bookmarks:
       if 'connection' not in b.vtypes:
         b.lrequest = None
+        validated([b])
         logger.info(f'{b.url} (skip)')
         continue
+      if ttl and b.lrequest and b.lrequest.is_recent(ttl):
+        logger.info(f'{b.url} (recently validated)')
+        continue
+      if since and b.lrequest and b.lrequest.date and b.lrequest.date >= since:
+        logger.info(f'{b.url} (validated before resuming)')
+        continue
+      bookmarks.append(b)
+
+    # each page is requested once, for one of the bookmarks sharing its canonical url
+    groups = self._group_by_page(bookmarks)
+
+    def page_validated(page):
+      # urls only differing in their canonical form are not reported as redirects
+      page_url = page.lrequest.redirect or page.url
+      page_key = self.canonical_key(page_url)
+      for b in groups[page]:
+        logger.info(f'{b.url} (same page as {page.url})')
+        b.copy_verification(page, page_url if self.canonical_key(b.url) != page_key else None)
+        if self.snapshots:
+          self.snapshots.link(str(b.id), str(page.id), b.url)
+      metrics.count('validate.shared_requests', len(groups[page]))
+      validated([page, *groups[page]])
+
+    breaker = web.HostBreaker(host_failures)
+    deferred = self._verify_pages(list(groups), workers, host_workers, breaker, page_validated)
+
+    # hosts that tripped the breaker get a single probe once the rest of the collection is done,
+    # probes run in parallel across hosts and the remaining urls of a host are only requested if it connects
+    hosts = {}
+    for b in sorted(deferred, key=self.order.get):
+      hosts.setdefault(web.get_host(b.url), []).append(b)
+    for pages in hosts.values():
+      breaker.half_open(pages[0].url)
+    self._verify_pages([pages[0] for pages in hosts.values()], workers, host_workers, breaker, page_validated)
+    failed = self._verify_pages([b for pages in hosts.values() for b in pages[1:]], workers, host_workers, breaker, page_validated)
+    # hosts still not connecting, with their number of urls not requested
+    tripped = {}
+    for b in failed:
+      host = web.get_host(b.url)
+      logger.info(f'{b.url} (host {host} not connecting, skip)')
+      b.lrequest = LastHttpRequest(False)
+      page_validated(b)
+      tripped[host] = tripped.get(host, 0) + 1
+    metrics.count('validate.host_skipped', len(failed))
+
+    if checkpoint:
+      self.save()
+      self._clear_checkpoint()
+    return tripped
+
+  def _group_by_page(self, bookmarks):
+    # bookmarks are grouped by their canonical url, or the one they last redirected to
+    keys = {}
+    for b in bookmarks:
+      redirect = b.lrequest.redirect if b.lrequest and b.lrequest.redirect else None
+      key = self.canonical_key(redirect or b.url)
+      keys.setdefault(key, []).append(b)
+    groups = {}
+    for key, group in keys.items():
+      # prefer the bookmark at the page url (no redirect) that validates the most
+      page = max(group, key=lambda b: (self.canonical_key(b.url) == key, len(b.vtypes)))
+      groups[page] = [b for b in group if b is not page]
+    return groups
+
+  def _verify_pages(self, bookmarks, workers, host_workers, breaker, validated):
+    # validated is called from this thread after each request, returns the bookmarks
+    # not requested because their host tripped the breaker
+    deferred = []
+
+    def verify(b, session=None):
+      if breaker.is_open(b.url):
+        deferred.append(b)
+        return None
       logger.info(b.url)
-      b.verify()
+      b.verify(session, self.snapshots)
+      breaker.record(b.url, b.lrequest.connected)
+      return b
+
+    if workers < 2:
+      for b in bookmarks:
+        if verify(b):
+          validated(b)
+      return deferred
+
+    session = web.get_session(workers)
+    limiter = web.HostLimiter(host_workers)
+
+    def verify_limited(b):
+      with limiter.get(b.url):
+        return verify(b, session)
+
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+      # consuming results also raises the exceptions of workers
+      for b in executor.map(verify_limited, web.interleave_by_host(bookmarks, lambda b: b.url)):
+        if b:
+          validated(b)
+    return deferred
 
   def sync_urls(self):
+    self.changes = None
     for b in self.bookmarks:
       if b.lrequest and b.lrequest.redirect:
-        b.update_url(b.lrequest.redirect)
+        self.update_url(b, b.lrequest.redirect)
         b.lrequest.redirect = None
 
   def sync_titles(self):
+    # titles are extracted again from the snapshot of the page last fetched when it is kept,
+    # without requesting the page
+    self.changes = None
     for b in self.bookmarks:
-      if b.lrequest and b.lrequest.title:
-        b.update_title(b.lrequest.title)
+      title = self.snapshot_title(b)
+      if title is None and b.lrequest:
+        title = b.lrequest.title
+      if title and title != b.title:
+        self.update_title(b, title)
+      if b.lrequest:
         b.lrequest.title = None
 
+  def snapshot_title(self, bookmark):
+    # title of the latest snapshot of a bookmark page, None if there is none
+    snapshots = self.open_snapshots()
+    page = snapshots.get(str(bookmark.id)) if snapshots and 'title' in bookmark.vtypes else None
+    return parse_title(*page) if page is not None else None
+
+  def find_near_duplicates(self, threshold=0.8):
+    # bookmarks with similar urls for the same page (same last path segment and query), grouped in
+    # clusters in collection order, and clusters of the other bookmarks with similar urls or titles.
+    # Titles alone like '404 Not Found' or urls of sibling pages don't make a duplicate, those are
+    # only reported, never merged
+    bookmarks = list(self)
+    urls = [dedup.get_url_features(b.url) for b in bookmarks]
+    pages = [dedup.get_url_page(b.url) for b in bookmarks]
+    similar = []
+    same_page = []
+    for a, b in dedup.similar_pairs(urls, threshold):
+      (same_page if pages[a] == pages[b] else similar).append((a, b))
+    clusters = dedup.group_pairs(same_page)
+    cluster_of = {i: n for n, cluster in enumerate(clusters) for i in cluster}
+    titles = [set() if b.title in self.ignore_titles else dedup.get_title_features(b.title) for b in bookmarks]
+    similar.extend(dedup.similar_pairs(titles, threshold))
+    similar = [(a, b) for a, b in similar if cluster_of.get(a, a) != cluster_of.get(b, -1)]
+    return (
+        [[bookmarks[i] for i in cluster] for cluster in clusters],
+        [[bookmarks[i] for i in cluster] for cluster in dedup.group_pairs(similar)]
+    )
+
+  def merge_duplicates(self, clusters):
+    # keeps the bookmark created first, with the tags and history of the others and their urls
+    # added to its history, so they are still found by url
+    self.changes = None
+    date = datetime.now().strftime(datetime_format)
+    merged = []
+    for cluster in clusters:
+      keep = min(cluster, key=lambda b: (b.created, self.order[b]))
+      others = [b for b in cluster if b is not keep]
+      history = [*keep.history]
+      for b in others:
+        history.extend(h for h in b.history if h not in history)
+        history.append({"date": date, "url": b.url})
+      self._unindex(keep)
+      keep.add_tags([t for b in others for t in b.tags])
+      keep.history = sorted(history, key=lambda h: h['date'])
+      self._index(keep)
+      self.refresh(keep)
+      merged.extend(others)
+    self.delete_bookmarks(merged)
+
+  def search(self, query, limit=20):
+    # returns the urls of the best matching bookmarks, building the index if needed
+    if not self.search_index:
+      self.search_index = BookmarkSearchIndex(self.search_fpath)
+      self.search_index.stale = not self.fpath or not self.search_index.is_current(self.files_stamp())
+    if self.search_index.stale:
+      self.search_index.rebuild(self, self.files_stamp() if self.fpath else None)
+    return self.search_index.search(query, limit)
+
   def get_bookmarks(self, by, value):
+    if self.lazy and self.db:
+      return [self._parse_bookmark(bjson) for bjson in self.db.find(by, value) or []]
+    if self.lazy:
+      return self._scan_bookmarks(by, value)
+    if by not in ['status', 'tag', 'created', 'domain', 'media']:
+      return None
+
+    index = self._get_attr_index(by)
+    if by == 'status':
+      keys = [int(value)]
+    elif by == 'tag' or by == 'domain':
+      keys = [value]
+    else:
+      # created and media match substrings, only distinct dates/media types are scanned
+      keys = [k for k in index if value in k]
+    if len(keys) == 1:
+      return self._sorted(index.get(keys[0], {}))
+    return self._sorted({b: None for k in keys for b in index[k]})
+
+  def _scan_bookmarks(self, by, value):
     if by == 'status':
-      return [b for b in self.bookmarks if b.status['code'] == int(value)]
+      return [b for b in self if b.status['code'] == int(value)]
     if by == 'tag':
-      return [b for b in self.bookmarks if value in b.tags]
+      return [b for b in self if value in b.tags]
     if by == 'created':
-      return [b for b in self.bookmarks if value in b.created.strftime(date_format)]
+      return [b for b in self if value in b.created.strftime(date_format)]
     if by == 'domain':
-      return [b for b in self.bookmarks if get_fld(b.url) == value]
+      return [b for b in self if web.get_domain(b.url) == value]
     if by == 'media':
-      return [b for b in self.bookmarks if value in b.mtype]
+      return [b for b in self if value in b.mtype]
 
   def get_urls(self, value, by):
     return [b.url for b in self.get_bookmarks(value, by)]
 
   def get_grouped_urls(self, by):
+    result = defaultdict(list)
+    if self.lazy and self.db:
+      for key, url in self.db.group(by):
+        if by == 'status':
+          key = f"{key} ({Bookmark.get_status_name(key)})"
+        result[key].append(url)
+      return result
+    if self.lazy:
+      return self._scan_grouped_urls(by)
+    if by not in ['status', 'tag', 'created', 'domain', 'media']:
+      return result
+
+    for key, bookmarks in self._get_attr_index(by).items():
+      if by == 'status':
+        key = f"{key} ({Bookmark.get_status_name(key)})"
+      result[key] = [b.url for b in self._sorted(bookmarks)]
+    return result
+
+  def _scan_grouped_urls(self, by):
     result = defaultdict(list)
     if by == 'status':
-      for b in self.bookmarks:
+      for b in self:
         result[f"{b.status['code']} ({b.status['name']})"].append(b.url)
     elif by == 'tag':
-      for b in self.bookmarks:
+      for b in self:
         for tag in b.tags:
           result[tag].append(b.url)
     elif by == 'created':
-      for b in self.bookmarks:
+      for b in self:
         result[b.created.strftime(date_format)].append(b.url)
     elif by == 'domain':
-      for b in self.bookmarks:
-        result[get_fld(b.url)].append(b.url)
+      for b in self:
+        result[web.get_domain(b.url)].append(b.url)
     elif by == 'media':
-      for b in self.bookmarks:
+      for b in self:
         result[b.mtype].append(b.url)
     return result
 
@@ -410,34 +1236,135 @@ class BookmarkCollection:
 class BookmarkCollectionCatalog:
 
   ignore_files = ['template.json', 'test.json']
+  manifest_fname = '.bkm-manifest'
 
-  def __init__(self, name, path):
+  def __init__(self, name, path, workers=None):
     self.name = name
     self.path = path
-    self.collections = []
+    self.workers = workers
+    self.fpaths = []
+    self._collections = None
     self.load()
 
   def load(self):
-    fpaths = [f for f in self.path.glob('*.json') if f.name not in self.ignore_files]
-    for cpath in fpaths:
-      bc = BookmarkCollection(cpath)
-      if bc.catalog == self.name:
-        self.collections.append(bc)
+    # only collection headers are read, and only for files changed since the manifest was written
+    manifest = self._read_manifest()
+    updated = False
+    self.fpaths = []
+    self._collections = None
+    for fpath in sorted(self.path.glob('*.json')):
+      if fpath.name in self.ignore_files: continue
+      stat = fpath.stat()
+      entry = manifest.get(fpath.name)
+      if not entry or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+        bc = BookmarkCollection()
+        bc.load_header(fpath)
+        entry = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "name": bc.name, "catalog": bc.catalog}
+        manifest[fpath.name] = entry
+        updated = True
+      if entry['catalog'] == self.name:
+        self.fpaths.append(fpath)
+    if updated:
+      self._write_manifest(manifest)
+
+  @property
+  def collections(self):
+    if self._collections is None:
+      self._collections = self._load_collections()
+    return self._collections
+
+  def _load_collections(self):
+    workers = min(self.workers or os.cpu_count() or 1, len(self.fpaths))
+    if workers < 2:
+      return [BookmarkCollection(f) for f in self.fpaths]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      loaded = executor.map(load_collection_data, self.fpaths)
+      return [self._build_collection(fpath, *data) for fpath, data in zip(self.fpaths, loaded)]
+
+  def _build_collection(self, fpath, name, description, catalog, bookmarks):
+    bc = BookmarkCollection(name=name, description=description, catalog=catalog)
+    bc.fpath = fpath
+    bc.bookmarks = bookmarks
+    bc.reindex()
+    return bc
+
+  def _read_manifest(self):
+    fpath = self.path / self.manifest_fname
+    if not fpath.exists():
+      return {}
+    try:
+      with open(fpath, encoding='utf-8') as f:
+        return json.load(f)
+    except (OSError, ValueError) as e:
+      logger.debug(f'not able to read catalog manifest {fpath}: {e}')
+      return {}
+
+  def _write_manifest(self, manifest):
+    fpath = self.path / self.manifest_fname
+    try:
+      with utils.atomic_open(fpath) as f:
+        json.dump(manifest, f)
+    except OSError as e:
+      logger.debug(f'not able to write catalog manifest {fpath}: {e}')
+
+
+def parse_title(html, encoding=None):
+  # only the head is parsed, bs4 is only loaded when a title is needed
+  import bs4
+  end = web.HEAD_END_PATTERN.search(html)
+  soup = bs4.BeautifulSoup(html[:end.end()] if end else html, 'html.parser', from_encoding=encoding)
+  return soup.title.text.strip() if soup.title else ''
+
+
+def load_collection_data(fpath):
+  # runs in catalog worker processes, collections are rebuilt (and indexed) in the parent
+  bc = BookmarkCollection(fpath)
+  return bc.name, bc.description, bc.catalog, bc.bookmarks
+
+
+def fetch_titles(urls, workers=8, host_workers=2):
+  # titles of the pages at urls, in order, fetched concurrently with at most host_workers per host
+  if workers < 2:
+    return [Bookmark(u).fetch_title() for u in urls]
+
+  session = web.get_session(workers)
+  limiter = web.HostLimiter(host_workers)
+
+  def fetch(url):
+    with limiter.get(url):
+      return Bookmark(url).fetch_title(session=session)
+
+  interleaved = web.interleave_by_host(urls, lambda u: u)
+  with session, ThreadPoolExecutor(max_workers=workers) as executor:
+    titles = dict(zip(interleaved, executor.map(fetch, interleaved)))
+  return [titles[u] for u in urls]
 
 
 class LastHttpRequest:
 
-  def __init__(self, connected, status=None, redirect=None, title=None):
+  __slots__ = ['connected', 'status', 'redirect', 'title', 'etag', 'modified', 'date', 'transferred']
+
+  def __init__(self, connected, status=None, redirect=None, title=None, etag=None, modified=None, date=None, transferred=None):
     self.connected = connected
     self.status = status
     self.redirect = redirect
     self.title = title
+    self.etag = etag
+    self.modified = modified
+    self.date = date if date else datetime.now()
+    # body bytes read by the request, None when the page was not requested for this bookmark
+    self.transferred = transferred
 
   def parse(self, data):
     self.connected = data['establishedConnection'] if 'establishedConnection' in data else False
     self.status = data['statusCode'] if 'statusCode' in data else None
     self.redirect = data['redirectUrl'] if 'redirectUrl' in data else None
     self.title = data['pageTitle'] if 'pageTitle' in data else ''
+    self.etag = data['etag'] if 'etag' in data else None
+    self.modified = data['lastModified'] if 'lastModified' in data else None
+    self.date = parse_datetime(data['date']) if 'date' in data else None
+    self.transferred = data['bytesTransferred'] if 'bytesTransferred' in data else None
 
   @property
   def json(self):
@@ -448,38 +1375,66 @@ class LastHttpRequest:
       data["redirectUrl"] = self.redirect
     if self.title:
       data["pageTitle"] = self.title
+    if self.etag:
+      data["etag"] = self.etag
+    if self.modified:
+      data["lastModified"] = self.modified
+    if self.date:
+      data["date"] = self.date.strftime(datetime_format)
+    if self.transferred is not None:
+      data["bytesTransferred"] = self.transferred
     return data
 
+  def is_recent(self, ttl):
+    return self.date is not None and datetime.now() - self.date < ttl
+
 
 class BookmarkCollectionParser(BookmarkCollection):
 
   title_pattern = r'^(#+)\s+(.+)$'
   link_pattern = r'^\*\s\[(.*)\]\s*\((https?:\/\/.+)\)\s*$'
 
-  def __init__(self, ftype, bookmarks=None):
+  def __init__(self, ftype, bookmarks=None, name='', description='', catalog='default'):
     self.ftype = ftype
+    self.changes = None
+    self.report = None
+    self.name = name
+    self.description = description
+    self.catalog = catalog
     self.bookmarks = bookmarks if bookmarks else []
+    self.search_index = None
+    self.snapshots = None
+    self.reindex()
 
   def parse(self, data):
     if self.ftype == 'json':
       return self._parse_json(data)
+    if self.ftype == 'db':
+      return self._parse_bookmarks(data)
     if self.ftype == 'md':
       return self._parse_md(data)
 
-  def _parse_json(self, data):
-    self.name = data['name']
-    self.description = data['description']
-    self.catalog = data['catalog']
-    for bjson in data['bookmarks']:
-      bookmark = Bookmark()
-      bookmark.parse_json(bjson)
-      if not self.add(bookmark):
-        logger.debug(f'not able to add: {bookmark.url}')
+  def _parse_json(self, reader):
+    self._parse_bookmarks(metrics.timed_iter('load.json_decode', reader))
+    self.name = reader.header['name']
+    self.description = reader.header['description']
+    self.catalog = reader.header['catalog']
+    return self
+
+  def _parse_bookmarks(self, data):
+    # stored collections only drop exact duplicates, canonical ones are kept as they were saved
+    # timed with the decoding of their json
+    bookmarks = metrics.timed_iter('load.bookmarks', (self._parse_bookmark(bjson) for bjson in data))
+    summary = self.add_many(bookmarks, exact=True)
+    if summary['skipped']:
+      logger.debug(f"not able to add {summary['skipped']} duplicated bookmarks")
     return self
 
   def _parse_md(self, data):
     cats = []
-    bkms = self.bookmarks.copy()
+    # dict used as an ordered set of the bookmarks not yet seen in the md file
+    bkms = dict.fromkeys(self.bookmarks)
+    self.report = {"added": [], "updated": [], "moved": [], "deleted": []}
 
     for line in data:
 
@@ -488,10 +1443,14 @@ class BookmarkCollectionParser(BookmarkCollection):
       if link_match:
         url = link_match[2]
         title = link_match[1]
-        bookmark = self.find_update(url, title)
+        bookmark = self.find(url)
+        added = not bookmark
         if bookmark:
+          if bookmark.title != title:
+            self.report['updated'].append(bookmark.url)
+          self.set_title(bookmark, title)
           if bookmark in bkms:
-            bkms.remove(bookmark)
+            del bkms[bookmark]
           else:
             logger.debug(f'duplicated: {bookmark.url}')
         else:
@@ -499,9 +1458,14 @@ class BookmarkCollectionParser(BookmarkCollection):
           if not self.add(bookmark):
             logger.debug(f'not able to add: {bookmark.url}')
             continue
+          self.report['added'].append(bookmark.url)
         if cats:
-          bookmark.categories = ' > '.join(cats)
+          categories = ' > '.join(cats)
+          if bookmark.categories != categories and not added:
+            self.report['moved'].append(bookmark.url)
+          bookmark.categories = categories
           bookmark.add_tags([utils.get_tag_from_category(t) for t in cats])
+          self.refresh(bookmark)
         continue
 
       # match title line
@@ -516,52 +1480,41 @@ class BookmarkCollectionParser(BookmarkCollection):
           cats.append(category)
 
     # remove missing bookmarks
-    for b in bkms:
-      if not self.delete(b):
-        logger.debug(f'not able to delete: {b.url}')
-      else:
-        logger.debug(f'deleted: {b.url}')
+    for b in self.delete_bookmarks(bkms):
+      self.report['deleted'].append(b.url)
+      logger.debug(f'deleted: {b.url}')
 
     return self
 
-  def import_nbff(self, data):
-    self._nbff_traverse_nodes(data.dl, 0, [])
-    return self
 
-  def _nbff_traverse_nodes(self, node, level, cats):
-    for child in node.children:
-      if type(child) == bs4.element.NavigableString: continue
-      if child.name == 'a':
-        url = child.get('href')
-        title = child.text
-        created = utils.get_date_from_unix_timestamp(child.get('add_date'))
-        bookmark = self.find(url, title)
-        if bookmark:
-          if created < bookmark.created:
-            bookmark.created = created
-        else:
-          bookmark = Bookmark(url, title, created)
-          bookmark.categories = utils.get_category_hierarchy_str(cats)
-          bookmark.tags = child.get('tags').split(',') if child.has_attr('tags') else [utils.get_tag_from_category(c) for c in cats]
-          if not self.add(bookmark):
-            logger.debug(f'not able to add: {bookmark.url}')
-      elif child.name == 'h3':
-        cats = cats[:level]
-        if len(cats) > level:
-          cats[level] = child.text
-        else:
-          cats.append(child.text)
-      elif child.name == 'dl':
-        self._nbff_traverse_nodes(child, level + 1, cats)
-      elif child.name in ['p', 'dt', 'dd']:
-        self._nbff_traverse_nodes(child, level, cats)
-
-  def import_instapaper(self, data):
-    for row in data:
+def parse_nbff(fpath):
+  with open(fpath, encoding='utf-8') as file:
+    for link in nbff.iter_links(file):
+      cats = link['categories']
+      created = utils.get_date_from_unix_timestamp(link['add_date']) if link.get('add_date') else None
+      bookmark = Bookmark(link.get('href'), link['title'], created)
+      bookmark.categories = utils.get_category_hierarchy_str(cats)
+      bookmark.tags = link['tags'].split(',') if link.get('tags') is not None else [utils.get_tag_from_category(c) for c in cats]
+      yield bookmark
+
+
+def parse_instapaper(fpath):
+  with open(fpath, encoding='utf-8') as csv_file:
+    for row in csv.DictReader(csv_file):
       bookmark = Bookmark(row['URL'], row['Title'])
       bookmark.created = utils.get_date_from_unix_timestamp(row['Timestamp'])
       bookmark.categories = row['Folder']
       bookmark.tags.append(utils.get_tag_from_category(row['Folder']))
-      if not self.add(bookmark):
-        logger.debug(f'not able to add: {bookmark.url}')
-    return self
+      yield bookmark
+
+
+# parser and add_many options for each import type, browser exports are also matched by title
+importers = {
+    'nbff': (parse_nbff, {"match_titles": True, "merge": True}),
+    'insta': (parse_instapaper, {})
+}
+
+
+def parse_file(itype, fpath):
+  # parsers are generators, worker processes send back the whole list of bookmarks of a file
+  return list(importers[itype][0](fpath))
@@ -0,0 +1,235 @@
+import json
+import sqlite3
+from collections import defaultdict
+
+from modules.web import get_domain
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS collection (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE TABLE IF NOT EXISTS bookmarks (
+  id TEXT PRIMARY KEY,
+  url TEXT NOT NULL,
+  title TEXT NOT NULL,
+  media_type TEXT,
+  created TEXT NOT NULL,
+  categories TEXT NOT NULL,
+  validation_types TEXT NOT NULL,
+  domain TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+  bookmark_id TEXT NOT NULL REFERENCES bookmarks(id) ON DELETE CASCADE,
+  position INTEGER NOT NULL,
+  tag TEXT NOT NULL,
+  PRIMARY KEY (bookmark_id, position)
+);
+CREATE TABLE IF NOT EXISTS history (
+  bookmark_id TEXT NOT NULL REFERENCES bookmarks(id) ON DELETE CASCADE,
+  position INTEGER NOT NULL,
+  date TEXT NOT NULL,
+  url TEXT,
+  title TEXT,
+  PRIMARY KEY (bookmark_id, position)
+);
+CREATE TABLE IF NOT EXISTS last_requests (
+  bookmark_id TEXT PRIMARY KEY REFERENCES bookmarks(id) ON DELETE CASCADE,
+  connected INTEGER NOT NULL,
+  status_code INTEGER,
+  redirect_url TEXT,
+  page_title TEXT,
+  etag TEXT,
+  last_modified TEXT,
+  date TEXT,
+  bytes_transferred INTEGER
+);
+CREATE INDEX IF NOT EXISTS bookmarks_url ON bookmarks(url);
+CREATE INDEX IF NOT EXISTS bookmarks_domain ON bookmarks(domain);
+CREATE INDEX IF NOT EXISTS bookmarks_created ON bookmarks(created);
+CREATE INDEX IF NOT EXISTS bookmarks_created_date ON bookmarks(substr(created, 1, 10));
+CREATE INDEX IF NOT EXISTS bookmarks_media_type ON bookmarks(media_type);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+CREATE INDEX IF NOT EXISTS history_url ON history(url);
+CREATE INDEX IF NOT EXISTS history_title ON history(title);
+CREATE INDEX IF NOT EXISTS last_requests_status_code ON last_requests(status_code);
+"""
+
+# same codes as Bookmark.status: 10 when never validated, 0 when the connection failed
+status_column = """
+CASE WHEN r.bookmark_id IS NULL THEN 10 WHEN NOT r.connected THEN 0 ELSE r.status_code END
+"""
+
+lrequest_fields = [
+    ('status_code', 'statusCode'),
+    ('redirect_url', 'redirectUrl'),
+    ('page_title', 'pageTitle'),
+    ('etag', 'etag'),
+    ('last_modified', 'lastModified'),
+    ('date', 'date'),
+    ('bytes_transferred', 'bytesTransferred')
+]
+
+
+class BookmarkDatabase:
+  # sqlite storage for bookmark collections, reading and writing bookmarks in their json format
+
+  header_keys = ['name', 'description', 'catalog']
+
+  def __init__(self, fpath):
+    self.fpath = fpath
+    self.conn = sqlite3.connect(str(fpath))
+    self.conn.execute('PRAGMA foreign_keys = ON')
+    self.conn.executescript(schema)
+    # databases written before last requests recorded the bytes they read
+    if 'bytes_transferred' not in [c[1] for c in self.conn.execute('PRAGMA table_info(last_requests)')]:
+      self.conn.execute('ALTER TABLE last_requests ADD COLUMN bytes_transferred INTEGER')
+
+  def close(self):
+    self.conn.close()
+
+  def read_header(self):
+    rows = dict(self.conn.execute('SELECT key, value FROM collection'))
+    return {k: rows.get(k, '') for k in self.header_keys}
+
+  def replace_all(self, header, bookmarks):
+    with self.conn:
+      for table in ['last_requests', 'history', 'tags', 'bookmarks', 'collection']:
+        self.conn.execute(f'DELETE FROM {table}')
+      self.conn.executemany('INSERT INTO collection VALUES (?, ?)', [(k, header[k]) for k in self.header_keys])
+      for bjson in bookmarks:
+        self._insert(bjson)
+
+  def apply(self, change):
+    # apply a single collection change (see BookmarkCollection._record) in its own transaction
+    op = change['op']
+    with self.conn:
+      if op == 'add':
+        self._insert(change['bookmark'])
+        return
+      bid = self._get_id(change['url'])
+      if not bid: return
+      if op == 'delete':
+        self.conn.execute('DELETE FROM bookmarks WHERE id = ?', (bid,))
+      elif op == 'add_tags':
+        tags = [r[0] for r in self.conn.execute('SELECT tag FROM tags WHERE bookmark_id = ? ORDER BY position', (bid,))]
+        for tag in change['tags']:
+          if tag not in tags:
+            self._insert_child('tags', bid, tag=tag)
+            tags.append(tag)
+      elif op == 'delete_tag':
+        self.conn.execute(
+            'DELETE FROM tags WHERE bookmark_id = ? AND position = (SELECT min(position) FROM tags WHERE bookmark_id = ? AND tag = ?)',
+            (bid, bid, change['tag'])
+        )
+      elif op == 'update_url':
+        self._insert_child('history', bid, date=change['date'], url=change['url'])
+        self.conn.execute('UPDATE bookmarks SET url = ?, domain = ? WHERE id = ?', (change['new_url'], get_domain(change['new_url']), bid))
+      elif op == 'update_title':
+        title = self.conn.execute('SELECT title FROM bookmarks WHERE id = ?', (bid,)).fetchone()[0]
+        self._insert_child('history', bid, date=change['date'], title=title)
+        self.conn.execute('UPDATE bookmarks SET title = ? WHERE id = ?', (change['title'], bid))
+      elif op == 'verify':
+        self.conn.execute('UPDATE bookmarks SET media_type = ? WHERE id = ?', (change['mtype'], bid))
+        self.conn.execute('DELETE FROM last_requests WHERE bookmark_id = ?', (bid,))
+        if change['lrequest']:
+          self._insert_last_request(bid, change['lrequest'])
+
+  def iter_bookmarks(self, where='', params=()):
+    ids_query = f'SELECT b.id FROM bookmarks b LEFT JOIN last_requests r ON r.bookmark_id = b.id {where}'
+    tags = self._group(f'SELECT bookmark_id, tag FROM tags WHERE bookmark_id IN ({ids_query}) ORDER BY bookmark_id, position', params)
+    history = self._group(f'SELECT bookmark_id, date, url, title FROM history WHERE bookmark_id IN ({ids_query}) ORDER BY bookmark_id, position', params)
+    query = f'SELECT b.*, r.* FROM bookmarks b LEFT JOIN last_requests r ON r.bookmark_id = b.id {where} ORDER BY b.rowid'
+    cursor = self.conn.execute(query, params)
+    columns = [c[0] for c in cursor.description]
+    for row in cursor:
+      yield self._to_json(dict(zip(columns, row)), tags, history)
+
+  def find(self, by, value):
+    if by == 'status':
+      return self.iter_bookmarks(f'WHERE {status_column} = ?', (int(value),))
+    if by == 'tag':
+      return self.iter_bookmarks('WHERE b.id IN (SELECT bookmark_id FROM tags WHERE tag = ?)', (value,))
+    if by == 'created':
+      if len(value) == 10:
+        return self.iter_bookmarks('WHERE substr(b.created, 1, 10) = ?', (value,))
+      return self.iter_bookmarks('WHERE instr(substr(b.created, 1, 10), ?) > 0', (value,))
+    if by == 'domain':
+      return self.iter_bookmarks('WHERE b.domain = ?', (value,))
+    if by == 'media':
+      return self.iter_bookmarks("WHERE instr(coalesce(b.media_type, 'unknown'), ?) > 0", (value,))
+
+  def group(self, by):
+    if by == 'status':
+      query = f'SELECT {status_column}, b.url FROM bookmarks b LEFT JOIN last_requests r ON r.bookmark_id = b.id ORDER BY b.rowid'
+    elif by == 'tag':
+      query = 'SELECT t.tag, b.url FROM tags t JOIN bookmarks b ON b.id = t.bookmark_id ORDER BY b.rowid, t.position'
+    elif by == 'created':
+      query = 'SELECT substr(created, 1, 10), url FROM bookmarks ORDER BY rowid'
+    elif by == 'domain':
+      query = 'SELECT domain, url FROM bookmarks ORDER BY rowid'
+    elif by == 'media':
+      query = "SELECT coalesce(media_type, 'unknown'), url FROM bookmarks ORDER BY rowid"
+    else:
+      return []
+    return self.conn.execute(query)
+
+  def _get_id(self, url):
+    row = self.conn.execute('SELECT id FROM bookmarks WHERE url = ? ORDER BY rowid LIMIT 1', (url,)).fetchone()
+    return row[0] if row else None
+
+  def _group(self, query, params):
+    grouped = defaultdict(list)
+    for row in self.conn.execute(query, params):
+      grouped[row[0]].append(row[1:])
+    return grouped
+
+  def _insert(self, bjson):
+    bid = bjson['id']
+    self.conn.execute(
+        'INSERT INTO bookmarks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (bid, bjson['url'], bjson['title'], bjson.get('mediaType'), bjson['created'], bjson['categories'],
+         json.dumps(bjson['validation']['types']), get_domain(bjson['url']))
+    )
+    self.conn.executemany('INSERT INTO tags VALUES (?, ?, ?)', [(bid, i, t) for i, t in enumerate(bjson['tags'])])
+    self.conn.executemany(
+        'INSERT INTO history VALUES (?, ?, ?, ?, ?)',
+        [(bid, i, h['date'], h.get('url'), h.get('title')) for i, h in enumerate(bjson.get('history', []))]
+    )
+    if 'lastHttpRequest' in bjson['validation']:
+      self._insert_last_request(bid, bjson['validation']['lastHttpRequest'])
+
+  def _insert_last_request(self, bid, lrequest):
+    values = [lrequest.get(key) for _, key in lrequest_fields]
+    columns = ', '.join(['bookmark_id', 'connected', *(c for c, _ in lrequest_fields)])
+    placeholders = ', '.join('?' * (len(lrequest_fields) + 2))
+    self.conn.execute(f'INSERT INTO last_requests ({columns}) VALUES ({placeholders})', (bid, lrequest['establishedConnection'], *values))
+
+  def _insert_child(self, table, bid, **values):
+    position = self.conn.execute(f'SELECT coalesce(max(position) + 1, 0) FROM {table} WHERE bookmark_id = ?', (bid,)).fetchone()[0]
+    columns = ', '.join(['bookmark_id', 'position', *values.keys()])
+    placeholders = ', '.join('?' * (len(values) + 2))
+    self.conn.execute(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', (bid, position, *values.values()))
+
+  def _to_json(self, row, tags, history):
+    bid = row['id']
+    data = {}
+    data["id"] = bid
+    data["url"] = row['url']
+    data["title"] = row['title']
+    if row['media_type'] is not None:
+      data["mediaType"] = row['media_type']
+    data["created"] = row['created']
+    data["tags"] = [t for t, in tags.get(bid, [])]
+    data["categories"] = row['categories']
+    data["validation"] = {"types": json.loads(row['validation_types'])}
+    if row['bookmark_id'] is not None:
+      lrequest = {"establishedConnection": bool(row['connected'])}
+      for column, key in lrequest_fields:
+        if row[column] is not None:
+          lrequest[key] = row[column]
+      data["validation"]["lastHttpRequest"] = lrequest
+    if bid in history:
+      data["history"] = [{"date": d, "url": u} if u is not None else {"date": d, "title": t} for d, u, t in history[bid]]
+    return data
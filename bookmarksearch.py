@@ -0,0 +1,91 @@
+import re
+import json
+import sqlite3
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE TABLE IF NOT EXISTS documents (
+  rowid INTEGER PRIMARY KEY,
+  id TEXT NOT NULL UNIQUE,
+  url TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+  title, url, tags, categories,
+  tokenize = "unicode61 tokenchars '-'",
+  prefix = '2 3'
+);
+"""
+
+# bm25 weights of the title, url, tags and categories columns
+weights = (10.0, 3.0, 5.0, 2.0)
+
+token_pattern = re.compile(r'[\w-]+\*?')
+
+
+class BookmarkSearchIndex:
+  # full-text index of a bookmark collection, changes are committed when the collection is saved
+  # and tagged with the state of its files, so an index left behind by other writes gets rebuilt
+
+  def __init__(self, fpath):
+    self.fpath = fpath
+    self.conn = sqlite3.connect(str(fpath))
+    self.conn.executescript(schema)
+    self.stale = False
+
+  def close(self):
+    self.conn.close()
+
+  def is_current(self, stamp):
+    row = self.conn.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+    return row is not None and json.loads(row[0]) == stamp
+
+  def commit(self, stamp):
+    # a stale index is left untagged, to be rebuilt by the next search
+    self.conn.execute("DELETE FROM meta WHERE key = 'stamp'")
+    if not self.stale:
+      self.conn.execute("INSERT INTO meta VALUES ('stamp', ?)", (json.dumps(stamp),))
+    self.conn.commit()
+
+  def rebuild(self, bookmarks, stamp):
+    self.conn.execute('DELETE FROM search')
+    self.conn.execute('DELETE FROM documents')
+    for b in bookmarks:
+      self.add(b)
+    self.stale = False
+    self.commit(stamp)
+
+  def add(self, bookmark):
+    cursor = self.conn.execute('INSERT OR REPLACE INTO documents (id, url) VALUES (?, ?)', (str(bookmark.id), bookmark.url))
+    self.conn.execute(
+        'INSERT INTO search (rowid, title, url, tags, categories) VALUES (?, ?, ?, ?, ?)',
+        (cursor.lastrowid, bookmark.title, bookmark.url, ' '.join(bookmark.tags), bookmark.categories)
+    )
+
+  def remove(self, bookmark):
+    row = self.conn.execute('SELECT rowid FROM documents WHERE id = ?', (str(bookmark.id),)).fetchone()
+    if not row: return
+    self.conn.execute('DELETE FROM search WHERE rowid = ?', row)
+    self.conn.execute('DELETE FROM documents WHERE rowid = ?', row)
+
+  def update(self, bookmark):
+    self.remove(bookmark)
+    self.add(bookmark)
+
+  def search(self, query, limit=20):
+    # every word has to match, words ending with * match as prefixes
+    terms = []
+    for token in token_pattern.findall(query.lower()):
+      word = token.rstrip('*')
+      if word:
+        terms.append(f'"{word}"*' if token.endswith('*') else f'"{word}"')
+    if not terms: return []
+    rows = self.conn.execute(
+        f'SELECT d.url FROM search s JOIN documents d ON d.rowid = s.rowid '
+        f'WHERE search MATCH ? ORDER BY bm25(search, {", ".join(map(str, weights))}) LIMIT ?',
+        (' '.join(terms), limit)
+    )
+    return [url for url, in rows]
@@ -0,0 +1,98 @@
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS snapshots (
+  hash TEXT PRIMARY KEY,
+  body BLOB NOT NULL,
+  size INTEGER NOT NULL,
+  used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_used ON snapshots (used);
+CREATE TABLE IF NOT EXISTS pages (
+  id TEXT PRIMARY KEY,
+  hash TEXT NOT NULL,
+  url TEXT NOT NULL,
+  encoding TEXT,
+  validator TEXT,
+  date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash);
+"""
+
+datetime_format = '%Y-%m-%d %H:%M:%S'
+
+
+class BookmarkSnapshotStore:
+  # compressed page bodies stored once per content hash, with the latest snapshot of each bookmark.
+  # Least recently used snapshots are evicted once they take more than max_bytes (compressed).
+  # Pages are stored by validation workers, so every access holds the lock
+
+  def __init__(self, fpath, max_bytes):
+    self.fpath = fpath
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(str(fpath), check_same_thread=False)
+    self.conn.executescript(schema)
+    self.size = self.conn.execute('SELECT coalesce(sum(size), 0) FROM snapshots').fetchone()[0]
+
+  def close(self):
+    self.conn.close()
+
+  def put(self, bid, url, body, encoding=None, validator=None):
+    digest = hashlib.sha256(body).hexdigest()
+    with self.lock, self.conn:
+      row = self.conn.execute('SELECT hash FROM pages WHERE id = ?', (bid,)).fetchone()
+      if not self.conn.execute('UPDATE snapshots SET used = ? WHERE hash = ?', (time.time(), digest)).rowcount:
+        compressed = zlib.compress(body)
+        self.conn.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?)', (digest, compressed, len(compressed), time.time()))
+        self.size += len(compressed)
+      self.conn.execute(
+          'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+          (bid, digest, url, encoding, validator, datetime.now().strftime(datetime_format))
+      )
+      if row and row[0] != digest:
+        self._delete_unused(row[0])
+      self._evict()
+    return digest
+
+  def get(self, bid, validator=None):
+    # body and encoding of the latest snapshot of a bookmark, None if there is none. With a validator,
+    # also None when it was stored with another etag (or last modified date) than the one given
+    with self.lock, self.conn:
+      row = self.conn.execute(
+          'SELECT s.hash, s.body, p.encoding, p.validator FROM pages p JOIN snapshots s ON s.hash = p.hash WHERE p.id = ?', (bid,)
+      ).fetchone()
+      if not row or validator and row[3] != validator: return None
+      self.conn.execute('UPDATE snapshots SET used = ? WHERE hash = ?', (time.time(), row[0]))
+    return zlib.decompress(row[1]), row[2]
+
+  def link(self, bid, source_bid, url):
+    # a bookmark for the same page as another one shares its snapshot
+    with self.lock, self.conn:
+      source = self.conn.execute('SELECT hash, encoding, validator, date FROM pages WHERE id = ?', (source_bid,)).fetchone()
+      if not source: return
+      row = self.conn.execute('SELECT hash FROM pages WHERE id = ?', (bid,)).fetchone()
+      self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)', (bid, source[0], url, *source[1:]))
+      if row and row[0] != source[0]:
+        self._delete_unused(row[0])
+
+  def _delete_unused(self, digest):
+    if self.conn.execute('SELECT 1 FROM pages WHERE hash = ? LIMIT 1', (digest,)).fetchone(): return
+    row = self.conn.execute('SELECT size FROM snapshots WHERE hash = ?', (digest,)).fetchone()
+    if row:
+      self.conn.execute('DELETE FROM snapshots WHERE hash = ?', (digest,))
+      self.size -= row[0]
+
+  def _evict(self):
+    while self.size > self.max_bytes:
+      row = self.conn.execute('SELECT hash, size FROM snapshots ORDER BY used LIMIT 1').fetchone()
+      if not row: break
+      self.conn.execute('DELETE FROM snapshots WHERE hash = ?', (row[0],))
+      self.conn.execute('DELETE FROM pages WHERE hash = ?', (row[0],))
+      self.size -= row[1]
@@ -0,0 +1,80 @@
+import os
+import json
+import signal
+import threading
+
+
+def request(fpath, data):
+  # sends a json request to the daemon listening at fpath, None when there is none
+  if not os.path.exists(fpath): return None
+  # only loaded when a daemon may be listening, every command checks for one
+  import socket
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(str(fpath))
+  except (ConnectionRefusedError, FileNotFoundError):
+    sock.close()
+    return None
+  with sock:
+    sock.sendall(json.dumps(data).encode() + b'\n')
+    sock.shutdown(socket.SHUT_WR)
+    chunks = []
+    while chunk := sock.recv(65536):
+      chunks.append(chunk)
+  return json.loads(b''.join(chunks))
+
+
+class Daemon:
+  # serves one json request at a time over a unix socket and calls flush every flush_seconds
+  # and on shutdown, both under the same lock
+
+  def __init__(self, fpath, handle, flush, flush_seconds=30):
+    self.fpath = fpath
+    self.handle = handle
+    self.flush = flush
+    self.flush_seconds = flush_seconds
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+
+  def serve_forever(self):
+    import socketserver
+    if request(self.fpath, {"ping": True}) is not None:
+      raise RuntimeError(f'a daemon is already listening at {self.fpath}')
+    if os.path.exists(self.fpath):
+      os.unlink(self.fpath)
+
+    daemon = self
+
+    class Handler(socketserver.StreamRequestHandler):
+
+      def handle(self):
+        data = json.loads(self.rfile.readline())
+        if 'ping' in data:
+          response = {"pong": True}
+        else:
+          with daemon.lock:
+            response = daemon.handle(data)
+        self.wfile.write(json.dumps(response).encode())
+
+    # terminating also saves pending changes
+    signal.signal(signal.SIGTERM, self._terminate)
+    flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+    flusher.start()
+    try:
+      with socketserver.UnixStreamServer(str(self.fpath), Handler) as server:
+        os.chmod(self.fpath, 0o600)
+        server.serve_forever()
+    finally:
+      self.stopped.set()
+      if os.path.exists(self.fpath):
+        os.unlink(self.fpath)
+      with self.lock:
+        self.flush()
+
+  def _terminate(self, signum, frame):
+    raise SystemExit(0)
+
+  def _flush_periodically(self):
+    while not self.stopped.wait(self.flush_seconds):
+      with self.lock:
+        self.flush()
@@ -0,0 +1,85 @@
+import re
+import struct
+from hashlib import shake_128
+from urllib.parse import urlsplit
+
+word_pattern = re.compile(r'[^\W_]+')
+
+
+def get_title_features(title):
+  return {w for w in word_pattern.findall(title.lower()) if len(w) > 1 or w.isdigit()}
+
+
+def get_url_features(url):
+  # path segments are kept whole with their position and query parameters with their value,
+  # so /forum/viewtopic.php?t=1 and ?t=2 or /library/os.html and os.path.html differ
+  parts = urlsplit(url.lower())
+  host = parts.netloc[4:] if parts.netloc.startswith('www.') else parts.netloc
+  if not host: return set()
+  segments = [f'{i}:{s}' for i, s in enumerate(s for s in parts.path.split('/') if s)]
+  params = [p for p in parts.query.split('&') if p and not p.startswith('utm_')]
+  return {host, *segments, *params}
+
+
+def get_url_page(url):
+  # last path segment and query parameters, urls of different pages differ here even when most
+  # of their path is shared, like two files of the same directory
+  parts = urlsplit(url.lower())
+  segments = [s for s in parts.path.split('/') if s]
+  params = sorted(p for p in parts.query.split('&') if p and not p.startswith('utm_'))
+  return segments[-1] if segments else '', *params
+
+
+def similar_pairs(features, threshold=0.8, bands=5, rows=4, min_features=3, seed=0):
+  # minhash signatures split in bands: items sharing a band are candidates, then checked with
+  # their exact jaccard similarity. Buckets are compared against their first item only, so
+  # common bands don't turn quadratic, other bands still find most of the missing pairs
+  size = bands * rows
+  salt = f'{seed}:'.encode()
+  unpack = struct.Struct(f'<{size}I').unpack
+  hashes = {}
+  buckets = {}
+  for i, f in enumerate(features):
+    if len(f) < min_features: continue
+    columns = []
+    for w in f:
+      h = hashes.get(w)
+      if h is None:
+        h = hashes[w] = unpack(shake_128(salt + w.encode()).digest(4 * size))
+      columns.append(h)
+    signature = list(map(min, *columns))
+    for band in range(bands):
+      key = (band, *signature[band * rows:(band + 1) * rows])
+      buckets.setdefault(key, []).append(i)
+
+  seen = set()
+  for items in buckets.values():
+    first = items[0]
+    for i in items[1:]:
+      if (first, i) in seen: continue
+      seen.add((first, i))
+      a, b = features[first], features[i]
+      if len(a & b) >= threshold * len(a | b):
+        yield first, i
+
+
+def group_pairs(pairs):
+  # union-find over the pairs, clusters are sorted by their items
+  parents = {}
+
+  def find(i):
+    parents.setdefault(i, i)
+    while parents[i] != i:
+      parents[i] = parents[parents[i]]
+      i = parents[i]
+    return i
+
+  for a, b in pairs:
+    ra, rb = find(a), find(b)
+    if ra != rb:
+      parents[max(ra, rb)] = min(ra, rb)
+
+  clusters = {}
+  for i in parents:
+    clusters.setdefault(find(i), []).append(i)
+  return sorted(sorted(c) for c in clusters.values())
@@ -0,0 +1,36 @@
+import os
+import json
+
+
+class Journal:
+  # append-only log of json entries, one per line
+
+  def __init__(self, fpath):
+    self.fpath = fpath
+
+  @property
+  def size(self):
+    return self.fpath.stat().st_size if self.fpath.exists() else 0
+
+  def append(self, entries):
+    if not entries: return
+    with open(self.fpath, 'a', encoding='utf8') as f:
+      for entry in entries:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  def read(self):
+    if not self.fpath.exists(): return
+    with open(self.fpath, encoding='utf8') as f:
+      for line in f:
+        if not line.strip(): continue
+        try:
+          yield json.loads(line)
+        except json.JSONDecodeError:
+          # a torn last line left by an interrupted append
+          return
+
+  def clear(self):
+    if self.fpath.exists():
+      self.fpath.unlink()
@@ -0,0 +1,92 @@
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+class JsonArrayReader:
+  # reads a json file holding a top-level object, streaming the items of one of its arrays.
+  # members found before the array are parsed on creation, the ones after it once iterated.
+
+  def __init__(self, file, key, chunk_size=65536):
+    self.file = file
+    self.key = key
+    self.chunk_size = chunk_size
+    self.decoder = json.JSONDecoder()
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+    self.header = {}
+    self.done = False
+    self._next_token('{')
+    self.found = self._parse_members()
+
+  def __iter__(self):
+    if self.done: return
+    self.done = True
+    if not self.found: return
+
+    self._next_token('[')
+    if self._peek() == ']':
+      self.pos += 1
+    else:
+      while True:
+        yield self._decode()
+        if self._next_token(',]') == ']':
+          break
+
+    if self._next_token(',}') == ',':
+      self._parse_members()
+
+  def _parse_members(self):
+    # parse object members until the streamed array is reached or the object ends
+    if self._peek() == '}':
+      self.pos += 1
+      return False
+    while True:
+      key = self._decode()
+      self._next_token(':')
+      if key == self.key:
+        return True
+      self.header[key] = self._decode()
+      if self._next_token(',}') == '}':
+        return False
+
+  def _fill(self):
+    if self.eof: return False
+    chunk = self.file.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return False
+    # drop consumed input so memory stays bounded by the largest item
+    self.buffer = self.buffer[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def _peek(self):
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+        self.pos += 1
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self._fill():
+        raise ValueError('unexpected end of json data')
+
+  def _next_token(self, tokens):
+    c = self._peek()
+    if c not in tokens:
+      raise ValueError(f"expected one of '{tokens}' at position {self.pos}, found '{c}'")
+    self.pos += 1
+    return c
+
+  def _decode(self):
+    self._peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        # a value ending at the buffer boundary (e.g. a number) may be incomplete
+        if end < len(self.buffer) or self.eof:
+          self.pos = end
+          return value
+      except json.JSONDecodeError:
+        if self.eof: raise
+      self._fill()
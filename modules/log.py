@@ -1,5 +1,4 @@
 import logging
-from logging.handlers import TimedRotatingFileHandler
 
 LOG_EXTENSION = '.log'
 
@@ -25,6 +24,8 @@ def get_logger(fname, log_path='logs', file_log_level='DEBUG', console_log_level
     # create file handler
     log_fpath = f'{log_path}/{fname}{LOG_EXTENSION}'
     if file_handler_type == 'rotating':
+      # logging.handlers is slow to import, it also loads socket and pickle
+      from logging.handlers import TimedRotatingFileHandler
       fh = TimedRotatingFileHandler(log_fpath, when='midnight', encoding='utf-8')
       fh.suffix = fh_suffix
     else:
@@ -37,5 +38,5 @@ def get_logger(fname, log_path='logs', file_log_level='DEBUG', console_log_level
 
 
 def remove_file_handler(logger):
-  fhandler = next(h for h in logger.handlers if isinstance(h, (logging.FileHandler, TimedRotatingFileHandler)))
+  fhandler = next(h for h in logger.handlers if isinstance(h, logging.FileHandler))
   logger.handlers.remove(fhandler)
@@ -0,0 +1,126 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+# upper bounds in milliseconds of latency histogram buckets, the last one is unbounded
+buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Metrics:
+  # timers, counters and latency histograms, only collected once enabled
+
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.timers = {}
+    self.counters = {}
+    self.histograms = {}
+
+  def timed(self, name, histogram=False):
+    # decorator timing every call, histogram also keeps the distribution of call latencies
+    def decorator(f):
+      @wraps(f)
+      def wrapper(*args, **kwargs):
+        if not self.enabled:
+          return f(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+          return f(*args, **kwargs)
+        finally:
+          elapsed = time.perf_counter() - start
+          self.add_time(name, elapsed)
+          if histogram:
+            self.observe(name, elapsed)
+      return wrapper
+    return decorator
+
+  def timed_iter(self, name, iterable):
+    # time spent producing the items of an iterable, like decoding them from a file
+    if not self.enabled:
+      yield from iterable
+      return
+    iterator = iter(iterable)
+    elapsed = 0
+    try:
+      while True:
+        start = time.perf_counter()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          break
+        finally:
+          elapsed += time.perf_counter() - start
+        yield item
+    finally:
+      self.add_time(name, elapsed)
+
+  def add_time(self, name, seconds):
+    with self.lock:
+      timer = self.timers.setdefault(name, [0, 0.0])
+      timer[0] += 1
+      timer[1] += seconds
+
+  def count(self, name, n=1):
+    if not self.enabled: return
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def observe(self, name, seconds):
+    ms = seconds * 1000
+    with self.lock:
+      histogram = self.histograms.setdefault(name, {"counts": [0] * (len(buckets) + 1), "max": 0.0})
+      histogram['counts'][bisect_left(buckets, ms)] += 1
+      histogram['max'] = max(histogram['max'], ms)
+
+  @property
+  def summary(self):
+    with self.lock:
+      return {
+          "timers": {k: {"calls": c, "seconds": round(t, 6)} for k, (c, t) in sorted(self.timers.items())},
+          "counters": dict(sorted(self.counters.items())),
+          "histograms": {
+              k: {
+                  "bucketsMs": [*buckets, None],
+                  "counts": list(h['counts']),
+                  "maxMs": round(h['max'], 3),
+                  "p50Ms": self._percentile(h['counts'], 0.5),
+                  "p95Ms": self._percentile(h['counts'], 0.95),
+                  "p99Ms": self._percentile(h['counts'], 0.99)
+              } for k, h in sorted(self.histograms.items())
+          }
+      }
+
+  def _percentile(self, counts, q):
+    # upper bound of the bucket holding the percentile, None when it is the unbounded one
+    total = sum(counts)
+    if not total: return None
+    seen = 0
+    for bound, c in zip([*buckets, None], counts):
+      seen += c
+      if seen >= q * total:
+        return bound
+    return None
+
+  def format(self):
+    lines = []
+    summary = self.summary
+    for name, t in summary['timers'].items():
+      lines.append(f"{name}: {t['seconds']:.3f}s ({t['calls']} calls)")
+    for name, n in summary['counters'].items():
+      lines.append(f'{name}: {n}')
+    for name, h in summary['histograms'].items():
+      p = [f'<{v}ms' if v is not None else f'>{buckets[-1]}ms' for v in (h['p50Ms'], h['p95Ms'], h['p99Ms'])]
+      lines.append(f"{name} latency: p50 {p[0]}, p95 {p[1]}, p99 {p[2]}, max {h['maxMs']:.0f}ms")
+    return '\n'.join(lines)
+
+  def write(self, fpath):
+    with open(fpath, 'w', encoding='utf8') as file:
+      json.dump(self.summary, file, indent=2)
+
+
+metrics = Metrics()
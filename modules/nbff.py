@@ -0,0 +1,58 @@
+from html.parser import HTMLParser
+
+
+class NbffParser(HTMLParser):
+  # event driven parser for Netscape bookmark files, keeping only the open folder names in memory
+
+  def __init__(self):
+    super().__init__(convert_charrefs=True)
+    self.folders = []
+    self.folder = None
+    self.link = None
+    self.text = None
+    self.links = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag == 'a':
+      self.link = dict(attrs)
+      self.text = []
+    elif tag == 'h3':
+      self.text = []
+    elif tag == 'dl':
+      # a folder's list follows its h3 heading, the outermost list has no heading
+      self.folders.append(self.folder)
+      self.folder = None
+
+  def handle_endtag(self, tag):
+    if tag == 'a' and self.link is not None:
+      if self.folders:
+        self.link['title'] = ''.join(self.text)
+        self.link['categories'] = [f for f in self.folders if f is not None]
+        self.links.append(self.link)
+      self.link = None
+      self.text = None
+    elif tag == 'h3' and self.text is not None:
+      self.folder = ''.join(self.text)
+      self.text = None
+    elif tag == 'dl' and self.folders:
+      self.folders.pop()
+
+  def handle_data(self, data):
+    if self.text is not None:
+      self.text.append(data)
+
+  def pop_links(self):
+    links = self.links
+    self.links = []
+    return links
+
+
+def iter_links(file, chunk_size=65536):
+  parser = NbffParser()
+  while True:
+    chunk = file.read(chunk_size)
+    if not chunk: break
+    parser.feed(chunk)
+    yield from parser.pop_links()
+  parser.close()
+  yield from parser.pop_links()
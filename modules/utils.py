@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from contextlib import contextmanager
 
 
 def get_script_name(fname):
@@ -29,3 +30,18 @@ def get_tag_from_category(cat):
 
 def get_category_hierarchy_str(cats):
   return ' > '.join(cats)
+
+
+@contextmanager
+def atomic_open(fpath, encoding='utf8'):
+  # write to a temporary file and move it over fpath once complete
+  tmp_fpath = fpath.with_name(f'.{fpath.name}.tmp')
+  try:
+    with open(tmp_fpath, 'w', encoding=encoding) as f:
+      yield f
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+  finally:
+    if tmp_fpath.exists():
+      tmp_fpath.unlink()
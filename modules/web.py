@@ -0,0 +1,144 @@
+import re
+import threading
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from itertools import zip_longest
+from urllib.parse import urlsplit, urlunsplit
+
+HEAD_END_PATTERN = re.compile(rb'</\s*(?:title|head)\s*>', re.IGNORECASE)
+
+
+def get(url, **kwargs):
+  # requests and tld are imported when first used, most commands never reach the network
+  import requests
+  return requests.get(url, **kwargs)
+
+
+def request(method, url, **kwargs):
+  import requests
+  return requests.request(method, url, **kwargs)
+
+
+def is_unreachable(error):
+  # the host could not be reached at all (dns failure, connection refused or timed out), as
+  # opposed to errors once connected, like a reset connection or a read timeout
+  import requests
+  from urllib3.exceptions import NewConnectionError
+  if isinstance(error, requests.exceptions.ConnectTimeout): return True
+  if not isinstance(error, requests.exceptions.ConnectionError): return False
+  reason = getattr(error.args[0], 'reason', error.args[0]) if error.args else None
+  return isinstance(reason, NewConnectionError)
+
+
+def get_session(pool_size=10):
+  import requests
+  from requests.adapters import HTTPAdapter
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+
+def read_head(response, max_bytes, chunk_size=8192):
+  # read a streamed html body until the title (or head) element is closed
+  head = bytearray()
+  for chunk in response.iter_content(chunk_size):
+    start = max(0, len(head) - 16)
+    head.extend(chunk)
+    if HEAD_END_PATTERN.search(head, start) or len(head) >= max_bytes:
+      break
+  return bytes(head[:max_bytes])
+
+
+def read_body(response, max_bytes, chunk_size=65536):
+  # read a streamed body, up to max_bytes
+  body = bytearray()
+  for chunk in response.iter_content(chunk_size):
+    body.extend(chunk)
+    if len(body) >= max_bytes:
+      break
+  return bytes(body[:max_bytes])
+
+
+def get_media_type(response):
+  ctype = response.headers.get('content-type', None)
+  return ctype.split(';', 1)[0].strip() if ctype else None
+
+
+@lru_cache(maxsize=2 ** 16)
+def get_domain(url):
+  # urls without a registrable domain, like localhost or an ip address, are grouped by host
+  from tld import get_fld
+  return get_fld(url, fail_silently=True) or urlsplit(url).hostname or 'unknown'
+
+
+def get_host(url):
+  return urlsplit(url).netloc.lower()
+
+
+def canonicalize_url(url, ignore_params=('utm_*',)):
+  # key shared by urls pointing to the same page: no scheme, fragment, default port,
+  # trailing slash or ignored query parameters, and a lowercase host
+  try:
+    parts = urlsplit(url.strip())
+    host = parts.hostname or ''
+    port = parts.port
+  except ValueError:
+    return url
+  if not host:
+    return url
+  if port and port not in (80, 443):
+    host = f'{host}:{port}'
+  query = parts.query
+  if query and ignore_params:
+    params = [p for p in query.split('&') if p and not any(fnmatchcase(p.split('=', 1)[0], i) for i in ignore_params)]
+    query = '&'.join(params)
+  return urlunsplit(('', host, parts.path.rstrip('/'), query, ''))[2:]
+
+
+def interleave_by_host(items, get_url):
+  # round-robin items across hosts so workers don't all queue on the same host
+  groups = {}
+  for item in items:
+    groups.setdefault(get_host(get_url(item)), []).append(item)
+  return [i for row in zip_longest(*groups.values()) for i in row if i is not None]
+
+
+class HostLimiter:
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.lock = threading.Lock()
+    self.semaphores = {}
+
+  def get(self, url):
+    host = get_host(url)
+    with self.lock:
+      if host not in self.semaphores:
+        self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+      return self.semaphores[host]
+
+
+class HostBreaker:
+  # stops requesting a host after a number of consecutive connection failures, 0 never stops
+
+  def __init__(self, threshold):
+    self.threshold = threshold
+    self.lock = threading.Lock()
+    self.failures = {}
+
+  def is_open(self, url):
+    if not self.threshold: return False
+    with self.lock:
+      return self.failures.get(get_host(url), 0) >= self.threshold
+
+  def record(self, url, connected):
+    host = get_host(url)
+    with self.lock:
+      self.failures[host] = 0 if connected else self.failures.get(host, 0) + 1
+
+  def half_open(self, url):
+    # let one more request through, a single failure opens it again
+    with self.lock:
+      self.failures[get_host(url)] = self.threshold - 1